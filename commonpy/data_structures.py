@@ -14,8 +14,10 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
+from   bisect import bisect_right
 import collections
-from   collections.abc import MutableSet
+import math
+from   collections.abc import MutableSet, Sequence
 from   contextlib import suppress
 
 
@@ -129,3 +131,272 @@ class CaseFoldSet(MutableSet):
     def update(self, values):
         for v in values:
             self.add(v)
+
+
+class SequenceView(Sequence):
+    '''A read-only view of a range of elements of a sequence, without copying.
+
+    A view is like the result of slicing the sequence (sequence[start:stop:step])
+    except that no elements are copied: the view refers to the underlying
+    sequence by index, and so reflects later changes to it.  Slicing a view
+    returns another view of the same underlying sequence.
+
+    Example: the following test will be True:
+    > list(SequenceView([1, 2, 3, 4, 5], 1, None, 2)) == [2, 4]
+    '''
+    def __init__(self, sequence, start=None, stop=None, step=None):
+        self._sequence = sequence
+        self._range = range(len(sequence))[start:stop:step]
+
+
+    def __repr__(self):
+        return '<{} of {} elements at {:x}>'.format(
+            type(self).__name__, len(self._range), id(self))
+
+
+    def __len__(self):
+        return len(self._range)
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            view = SequenceView.__new__(SequenceView)
+            view._sequence = self._sequence
+            view._range = self._range[index]
+            return view
+        return self._sequence[self._range[index]]
+
+
+    def __iter__(self):
+        sequence = self._sequence
+        for i in self._range:
+            yield sequence[i]
+
+
+    def __eq__(self, other):
+        if isinstance(other, (SequenceView, list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+
+class BloomFilter():
+    '''A set-like structure that records items in a fixed amount of memory.
+
+    A Bloom filter can tell whether an item has definitely not been added,
+    but may wrongly report that an item was added (a false positive).  It
+    is sized for 'capacity' items with a false positive rate of about
+    'error_rate'; adding more items than 'capacity' raises the rate.  Items
+    must be hashable.  Memory use is about 1.2 bytes per item of capacity
+    when 'error_rate' is 0.001.  Since the filter uses Python's hash(),
+    filters are only meaningful within a single run of a program.
+
+    Example: the following test will be True:
+    > 'foo' in BloomFilter(100, items=['foo'])
+    '''
+    def __init__(self, capacity, error_rate=0.001, items=()):
+        if capacity < 1 or not 0 < error_rate < 1:
+            raise ValueError('Invalid BloomFilter capacity or error rate')
+        self._size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2)**2))
+        self._hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+        for item in items:
+            self.add(item)
+
+
+    def __repr__(self):
+        return '<{} of {} bits at {:x}>'.format(type(self).__name__, self._size, id(self))
+
+
+    def __contains__(self, item):
+        bits = self._bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self._positions(item))
+
+
+    def add(self, item):
+        '''Adds item, and returns True if it was (probably) present already.'''
+        bits = self._bits
+        present = True
+        for i in self._positions(item):
+            mask = 1 << (i & 7)
+            if not bits[i >> 3] & mask:
+                present = False
+                bits[i >> 3] |= mask
+        return present
+
+
+    def _positions(self, item):
+        # Double hashing: the positions are h1 + i * h2, for i in 0..k-1.
+        size = self._size
+        h1 = hash(item)
+        h2 = hash((item, 0x9e3779b9)) | 1
+        return ((h1 + i * h2) % size for i in range(self._hashes))
+
+
+class RangeSet():
+    '''A set of integers stored compactly as sorted, non-overlapping ranges.
+
+    A RangeSet can be created from a range expression such as "1-5,9,20-30"
+    (with the same rules for each range as expanded_range() in data_utils),
+    or from an iterable of integers and (start, end) pairs, where the end is
+    inclusive.  Membership tests take O(log n) time for n ranges, iteration
+    produces the integers lazily in increasing order, and the operators
+    | & - (or methods union, intersection, and difference) combine sets.
+    RangeSets are immutable.
+
+    Example: the following test will be True:
+    > 15 not in RangeSet('1-5,9,20-30') and len(RangeSet('1-5,9')) == 6
+    '''
+    def __init__(self, spec=None):
+        if spec is None:
+            intervals = []
+        elif isinstance(spec, str):
+            intervals = [self._parsed(part.strip()) for part in spec.split(',')
+                         if part.strip()]
+        else:
+            intervals = [(item, item) if isinstance(item, int) else
+                         (min(item), max(item)) for item in spec]
+        self._set(_merged(sorted(intervals)))
+
+
+    @staticmethod
+    def _parsed(text):
+        if '-' not in text:
+            if not text.isdigit():
+                raise ValueError(f'Malformed range expression: "{text}"')
+            return (int(text), int(text))
+        # This makes the range 1-100 be 1, 2, ..., 100 instead of 1, 2, ..., 99
+        bounds = [bound.strip() for bound in text.split('-')]
+        # Malformed cases of -x, where first number is missing.  Take it as 1.
+        if not bounds[0].isdigit():
+            bounds = [1, bounds[1]]
+        # Malformed cases of x-, where 2nd number missing.  Can't handle this.
+        if not bounds[1].isdigit():
+            raise ValueError(f'Malformed range expression: "{text}"')
+        bounds.sort(key=int)
+        return (int(bounds[0]), int(bounds[1]))
+
+
+    def _set(self, intervals):
+        self._starts = [start for start, _ in intervals]
+        self._ends = [end for _, end in intervals]
+        return self
+
+
+    @classmethod
+    def _from(cls, intervals):
+        return cls.__new__(cls)._set(intervals)
+
+
+    @property
+    def intervals(self):
+        '''The list of (start, end) pairs of the ranges, in increasing order.'''
+        return list(zip(self._starts, self._ends))
+
+
+    def __repr__(self):
+        return f"{type(self).__name__}('{self}')"
+
+
+    def __str__(self):
+        return ','.join(str(start) if start == end else f'{start}-{end}'
+                        for start, end in zip(self._starts, self._ends))
+
+
+    def __contains__(self, value):
+        if isinstance(value, str):
+            if not value.isdigit():
+                return False
+            value = int(value)
+        elif not isinstance(value, int):
+            return False
+        i = bisect_right(self._starts, value) - 1
+        return i >= 0 and value <= self._ends[i]
+
+
+    def __iter__(self):
+        for start, end in zip(self._starts, self._ends):
+            yield from range(start, end + 1)
+
+
+    def __len__(self):
+        return sum(end - start + 1 for start, end in zip(self._starts, self._ends))
+
+
+    def __bool__(self):
+        return bool(self._starts)
+
+
+    def __eq__(self, other):
+        if not isinstance(other, RangeSet):
+            return NotImplemented
+        return self._starts == other._starts and self._ends == other._ends
+
+
+    __hash__ = None
+
+
+    def __or__(self, other):
+        return self.union(other)
+
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+
+    def union(self, other):
+        '''Return a RangeSet of the integers in either this set or other.'''
+        return RangeSet._from(_merged(sorted(self.intervals + other.intervals)))
+
+
+    def intersection(self, other):
+        '''Return a RangeSet of the integers in both this set and other.'''
+        result = []
+        mine, theirs = self.intervals, other.intervals
+        i = j = 0
+        while i < len(mine) and j < len(theirs):
+            start = max(mine[i][0], theirs[j][0])
+            end = min(mine[i][1], theirs[j][1])
+            if start <= end:
+                result.append((start, end))
+            if mine[i][1] < theirs[j][1]:
+                i += 1
+            else:
+                j += 1
+        return RangeSet._from(result)
+
+
+    def difference(self, other):
+        '''Return a RangeSet of the integers in this set but not in other.'''
+        result = []
+        theirs = other.intervals
+        j = 0
+        for start, end in self.intervals:
+            # Skip ranges of other that end before this range starts.
+            while j < len(theirs) and theirs[j][1] < start:
+                j += 1
+            k = j
+            while k < len(theirs) and theirs[k][0] <= end:
+                if theirs[k][0] > start:
+                    result.append((start, theirs[k][0] - 1))
+                start = max(start, theirs[k][1] + 1)
+                k += 1
+            if start <= end:
+                result.append((start, end))
+        return RangeSet._from(result)
+
+
+def _merged(intervals):
+    '''Return sorted (start, end) pairs with overlapping or adjacent ones
+    combined.'''
+    result = []
+    for start, end in intervals:
+        if result and start <= result[-1][1] + 1:
+            if end > result[-1][1]:
+                result[-1] = (result[-1][0], end)
+        else:
+            result.append((start, end))
+    return result
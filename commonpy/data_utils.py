@@ -14,12 +14,23 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
+from   array import array
 from   boltons.strutils import pluralize
+from   collections import deque, namedtuple, OrderedDict
 from   collections.abc import MutableMapping
+from   concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from   concurrent.futures import wait, FIRST_COMPLETED
 from   datetime import datetime as dt
 from   dateutil import tz
+from   itertools import islice
+import os
+import traceback
 from   typing import Sequence, Generator, Iterator, KeysView, ValuesView
 
+from .data_structures import BloomFilter, RangeSet, SequenceView
+from .exceptions import TaskFailure
+from .interrupt import interrupted, raise_for_interrupts
+
 
 # Constants.
 # .............................................................................
@@ -28,16 +39,161 @@ DATE_FORMAT = '%b %d %Y %H:%M:%S %Z'
 '''Format in which lastmod date is printed back to the user. The value is used
 with datetime.strftime().'''
 
+Column = namedtuple('Column', 'values mask')
+Column.__doc__ = '''One column of the result of columnized().  The field
+"values" holds the column's value for each record, and "mask" holds True for
+each record that did not have a value for the column (in which case the
+entry in "values" is None, or 0 for numeric arrays).'''
+
 
 # Functions.
 # .............................................................................
 
-def sliced(lst, n):
-    '''Yield n number of slices from lst.'''
-    # Original algorithm from Jurgen Strydom posted 2019-02-21 Stack Overflow
-    # https://stackoverflow.com/a/54802737/743730
-    for i in range(n):
-        yield lst[i::n]
+def sliced(lst, n, views=False):
+    '''Yield n number of slices from lst.
+
+    Slice i holds elements i, i + n, i + 2n, ... of lst.  If "views" is True
+    and lst is a sequence, the slices are SequenceView objects that refer to
+    lst instead of copies of its elements.  If lst is not a sequence (e.g.,
+    it's a generator), the slices are iterators that draw elements from lst
+    as they are needed; items taken from lst for one slice but not yet
+    consumed from it are buffered, so memory use stays bounded only if the
+    slices are consumed in step (e.g., using zip()).
+    '''
+    if isinstance(lst, Iterator) or not hasattr(lst, '__getitem__'):
+        yield from _round_robin(lst, n)
+    elif views and isinstance(lst, Sequence):
+        for i in range(n):
+            yield SequenceView(lst, i, None, n)
+    else:
+        # Original algorithm from Jurgen Strydom posted 2019-02-21 Stack Overflow
+        # https://stackoverflow.com/a/54802737/743730
+        for i in range(n):
+            yield lst[i::n]
+
+
+def chunked(items, size):
+    '''Yield successive pieces of up to "size" elements from "items".
+
+    If "items" is a list or other sequence, the pieces are SequenceView
+    objects that refer to it without copying its elements (except for
+    strings, bytes and memoryviews, for which slices are returned).  For
+    any other kind of iterable, including generators and iterators that may
+    be unbounded, the pieces are lists, and only one piece is held in memory
+    at a time.
+    '''
+    if size < 1:
+        raise ValueError('Chunk size must be at least 1')
+    if isinstance(items, (str, bytes, bytearray, memoryview)):
+        for start in range(0, len(items), size):
+            yield items[start:start + size]
+    elif isinstance(items, Sequence):
+        for start in range(0, len(items), size):
+            yield SequenceView(items, start, start + size)
+    else:
+        iterator = iter(items)
+        while True:
+            chunk = list(islice(iterator, size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def chunked_by_size(items, max_size, size=None, max_items=None):
+    '''Yield lists of consecutive elements of "items" whose total size is at
+    most "max_size".
+
+    The size of each element is computed by calling the function "size"; by
+    default, it's the number of bytes in a bytes-like object, or in the UTF-8
+    encoding of a string, or else the len() of the element.  An element that
+    is larger than "max_size" by itself is put in a list of its own.  If
+    "max_items" is given, lists have at most that many elements.  Elements
+    are consumed as needed, so "items" can be an unbounded iterator.
+    '''
+    size = size or _byte_size
+    batch = []
+    total = 0
+    for item in items:
+        item_size = size(item)
+        if batch and (total + item_size > max_size
+                      or (max_items and len(batch) >= max_items)):
+            yield batch
+            batch = []
+            total = 0
+        batch.append(item)
+        total += item_size
+    if batch:
+        yield batch
+
+
+def parallel_map(function, items, workers=None, processes=False, ordered=True,
+                 chunk_size=None):
+    '''Yield the results of calling "function" on each element of "items",
+    running the calls in parallel in a pool of threads or processes.
+
+    This is a parallel version of map(function, items).  The pool has
+    "workers" threads (or processes, if "processes" is True), by default one
+    per CPU.  Processes are needed to speed up CPU-bound work written in
+    Python; "function" and the items must then be picklable (e.g., the
+    function must be defined at the top level of a module).  Items are sent
+    to the workers in chunks of "chunk_size" elements to reduce overhead;
+    by default, the size is chosen so that each worker gets several chunks,
+    if the number of items is known.  Only a few chunks per worker are in
+    progress at a time, so "items" can be a large or unbounded iterator.
+
+    If "ordered" is True, results are yielded in the order of "items";
+    otherwise, they are yielded as chunks finish.  If a call of "function"
+    raises an exception, outstanding work is cancelled and TaskFailure is
+    raised with the original exception as its cause; its attributes "index"
+    and "item" identify the item, and "details" holds the text of the
+    original traceback.  If interrupt() is called (see the
+    interrupt module), outstanding work is cancelled and the exception
+    configured with config_interrupt() is raised.
+    '''
+    workers = workers or os.cpu_count() or 1
+    if chunk_size is None:
+        if hasattr(items, '__len__'):
+            chunk_size = max(1, -(-len(items) // (workers * 4)))
+        else:
+            chunk_size = 16
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    chunks = enumerate(chunked(items, chunk_size))
+    pending = deque()
+    exhausted = False
+    with pool(max_workers=workers) as executor:
+        try:
+            while True:
+                while not exhausted and len(pending) < workers * 2:
+                    try:
+                        number, chunk = next(chunks)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    # A view would be pickled along with the whole sequence.
+                    chunk = list(chunk) if processes else chunk
+                    pending.append(executor.submit(_mapped_chunk, function,
+                                                   number * chunk_size, chunk))
+                if not pending:
+                    return
+                # Wake up periodically to check for interrupts.
+                done, _ = wait([pending[0]] if ordered else pending, timeout=0.25,
+                               return_when=FIRST_COMPLETED)
+                raise_for_interrupts()
+                for future in [f for f in pending if f in done]:
+                    pending.remove(future)
+                    results, failure = future.result()
+                    yield from results
+                    if failure:
+                        index, item, ex, details = failure
+                        name = getattr(function, '__name__', repr(function))
+                        error = TaskFailure(f'{name} failed on item {index}: {ex}')
+                        error.index = index
+                        error.item = item
+                        error.details = details
+                        raise error from ex
+        finally:
+            for future in pending:
+                future.cancel()
 
 
 def flattened(original, parent_key=False, separator='.'):
@@ -49,53 +205,225 @@ def flattened(original, parent_key=False, separator='.'):
     :return: A flattened original
     '''
 
+    # The work is done without recursion (see iter_flattened()), so that
+    # deeply-nested structures don't run into Python's recursion limit.
     if isinstance(original, dict):
-        # Case of a dict. Original algorithm by "Nikhil VJ" to Stack Overflow
-        # at https://stackoverflow.com/a/62186294/743730. Version of 2021-05-30.
-        items = []
-        for key, value in original.items():
-            new_key = str(parent_key) + separator + key if parent_key else key
-            if isinstance(value, MutableMapping):
-                if not value.items():
-                    items.append((new_key, None))
-                else:
-                    items.extend(flattened(value, new_key, separator).items())
-            elif isinstance(value, Sequence) and not isinstance(value, (str, bytes)):
-                if len(value) > 0:
-                    for k, v in enumerate(value):
-                        items.extend(flattened({str(k): v}, new_key, separator).items())
-                else:
-                    items.append((new_key, []))
-            else:
-                items.append((new_key, value))
-        return dict(items)
-
+        return dict(_flattened_items(original, parent_key, separator))
     if isinstance(original, (Sequence, Generator, Iterator, ValuesView, KeysView)):
-        # Solution based in part on Stack Overflow posting by "telliott99" on
-        # 2010-01-28 at https://stackoverflow.com/q/2158395/743730.
-        result = []
-        for el in original:
-            if isinstance(el, (str, bytes)):
-                result.append(el)
-            elif isinstance(el, Sequence):
-                result.extend(flattened(el, separator=separator))
-            elif isinstance(el, (KeysView, ValuesView)):
-                result.extend(el)
-            else:
-                result.append(flattened(el, separator=separator))
-        return result
+        return list(_flattened_elements(original, separator))
 
     # Fallback if we don't know how to deal with this kind of thing.
     return original
 
 
+def iter_flattened(original, parent_key=False, separator='.'):
+    '''Yield the contents of a nested list or dictionary as flattened() would
+    produce them, without building intermediate dictionaries or lists.
+
+    For a dict, this yields (key, value) pairs; for a list (or other kind of
+    sequence or iterator), it yields the elements of the flattened list.  If
+    flattening a dict produces the same key more than once (e.g., because
+    the dict has both a key "a.b" and a key "a" whose value has a key "b"),
+    all the pairs are yielded, whereas flattened() keeps the last value.
+
+    :param original: The original to flatten (a dict or a list)
+    :param parent_key: The string to prepend to original's keys (if a dict)
+    :param separator: The string used to separate flattened keys (if a dict)
+    '''
+    if isinstance(original, dict):
+        return _flattened_items(original, parent_key, separator)
+    if isinstance(original, (Sequence, Generator, Iterator, ValuesView, KeysView)):
+        return _flattened_elements(original, separator)
+    raise TypeError(f'Cannot flatten a value of type {type(original).__name__}')
+
+
+def columnized(records, separator='.', kind='list'):
+    '''Return the contents of a sequence of nested dicts as flat columns.
+
+    Each record in the iterable "records" is flattened as by flattened(), and
+    the result is a dict mapping each flattened key found in any record
+    (in the order the keys were first seen) to a Column named tuple.  Records
+    are consumed one at a time, so "records" can be a generator.  The value
+    of "kind" determines the type of the Column "values" and "mask" fields:
+
+      'list': plain lists.
+      'array': array.array objects for columns whose values are all ints
+        (typecode 'q') or all numbers (typecode 'd'), and lists otherwise;
+        masks are arrays of typecode 'B'.
+      'numpy': NumPy arrays (int64, float64 or bool where possible, else
+        object), with boolean masks.  This requires NumPy to be installed.
+
+    The inverse operation is provided by uncolumnized().
+    '''
+    if kind not in ('list', 'array', 'numpy'):
+        raise ValueError(f'Unknown kind of columns: {kind}')
+    if kind == 'numpy':
+        # NumPy is a large package that is not a dependency of CommonPy.
+        import numpy
+
+    columns = {}
+    count = 0
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            raise TypeError(f'Records must be dicts, not {type(record).__name__}')
+        for key, value in _flattened_items(record, False, separator):
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = []
+            if len(column) > index:
+                column[-1] = value          # Duplicate key; keep the last.
+                continue
+            if len(column) < index:
+                column.extend([_MISSING] * (index - len(column)))
+            column.append(value)
+        count = index + 1
+
+    result = {}
+    for key, values in columns.items():
+        if len(values) < count:
+            values.extend([_MISSING] * (count - len(values)))
+        mask = [value is _MISSING for value in values]
+        if any(mask):
+            values = [None if value is _MISSING else value for value in values]
+        if kind == 'array':
+            result[key] = Column(_as_array(values, mask), array('B', mask))
+        elif kind == 'numpy':
+            result[key] = Column(_as_numpy(numpy, values, mask), numpy.array(mask, dtype=bool))
+        else:
+            result[key] = Column(values, mask)
+    return result
+
+
+def uncolumnized(columns, separator='.'):
+    '''Yield nested dicts reconstructed from the result of columnized().
+
+    Each record is rebuilt from the unmasked values in each column using
+    unflattened(), so that records flattened and columnized are restored
+    with the same limitations as described for unflattened().
+    '''
+    if not columns:
+        return
+    names = list(columns)
+    count = len(columns[names[0]].mask)
+    for i in range(count):
+        yield unflattened({name: _plain(columns[name].values[i]) for name in names
+                           if not columns[name].mask[i]}, separator)
+
+
+def unflattened(flat, separator='.'):
+    '''Return a nested dict reconstructed from a dict made by flattened().
+
+    Keys are split at each "separator" to recreate the nesting, and dicts
+    whose keys are exactly the strings "0", "1", ... are turned into lists.
+    This exactly reverses flattened() provided that the original dict's
+    keys are strings that contain no "separator" and do not consist only
+    of digits, and that the original contains no empty dicts (flattened()
+    turns those into None).
+    '''
+    result = {}
+    made = {id(result): result}         # Dicts made here, as opposed to values.
+    for key, value in flat.items():
+        parts = key.split(separator) if isinstance(key, str) else [key]
+        container = result
+        for part in parts[:-1]:
+            child = container.get(part, _MISSING)
+            if child is _MISSING:
+                child = container[part] = {}
+                made[id(child)] = child
+            elif id(child) not in made:
+                raise ValueError(f'Conflicting values for flattened key "{key}"')
+            container = child
+        if id(container.get(parts[-1])) in made:
+            raise ValueError(f'Conflicting values for flattened key "{key}"')
+        container[parts[-1]] = value
+
+    # Convert dicts with keys "0", "1", ... to lists.  Visiting the dicts in
+    # the reverse of the order in which they are found converts inner ones
+    # before the outer ones that contain them.
+    found = []
+    pending = [(result, None, None)]
+    while pending:
+        node, parent, key = pending.pop()
+        found.append((node, parent, key))
+        pending.extend((value, node, k) for k, value in node.items()
+                       if id(value) in made)
+    for node, parent, key in reversed(found):
+        if parent is not None and all(k == str(i) for i, k in enumerate(node)):
+            parent[key] = list(node.values())
+    return result
+
+
 def unique(lst):
-    '''Take list "lst" and return a version without duplicates.'''
+    '''Take list "lst" and return a version without duplicates.
+
+    The order of the result is arbitrary.  To remove duplicates from a large
+    or unbounded stream while preserving order, use deduplicated().
+    '''
     # This exists because I think the intention behind list(set(...)) is
     # too easily lost and makes code muddier.
     return list(set(lst))
 
 
+def deduplicated(items, key=None, mode='exact', size=None, error_rate=0.001):
+    '''Return an iterator over "items" that skips repeated items.
+
+    Items are produced in the order they are first seen, and "items" is
+    consumed lazily, so it can be a generator.  If "key" is given, two items
+    are duplicates if key() returns equal values for them.  Items (or keys)
+    that are unhashable, such as dicts and lists, are compared by value.
+    The "dropped" attribute of the returned iterator counts the number of
+    duplicates skipped so far.  The value of "mode" determines how seen
+    items are remembered:
+
+      'exact': all distinct keys are kept in memory.
+      'window': only the "size" (default 100,000) most recently seen keys
+        are kept, so repeats further apart than that are not detected.
+      'bloom': a BloomFilter sized for "size" (default 10,000,000) keys
+        with false positive rate "error_rate" is used; it takes a fixed
+        amount of memory, but may wrongly skip a small fraction of items.
+    '''
+    if mode == 'exact':
+        seen = set()
+        test = _added_to_set(seen)
+    elif mode == 'window':
+        seen = OrderedDict()
+        test = _added_to_window(seen, size or 100000)
+    elif mode == 'bloom':
+        test = BloomFilter(size or 10000000, error_rate).add
+    else:
+        raise ValueError(f'Unknown deduplication mode: {mode}')
+    return Deduplicated(items, key, test)
+
+
+class Deduplicated():
+    '''Iterator returned by deduplicated().'''
+
+    def __init__(self, items, key, test):
+        self._items = iter(items)
+        self._key = key
+        self._test = test
+        self.dropped = 0
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        key = self._key
+        test = self._test
+        for item in self._items:
+            value = key(item) if key else item
+            try:
+                repeated = test(value)
+            except TypeError:               # Unhashable.
+                repeated = test(_canonical(value))
+            if not repeated:
+                return item
+            self.dropped += 1
+        raise StopIteration
+
+
 def ordinal(n):
     '''Print a number followed by "st" or "nd" or "rd", as appropriate.'''
     # Spectacular algorithm by user "Gareth" at this posting:
@@ -104,18 +432,14 @@ def ordinal(n):
 
 
 def expanded_range(text):
-    '''Return individual numbers for a range expressed as X-Y.'''
-    # This makes the range 1-100 be 1, 2, ..., 100 instead of 1, 2, ..., 99
-    if '-' in text:
-        range_list = text.split('-')
-        # Malformed cases of -x, where first number is missing.  Take it as 1.
-        if not range_list[0].isdigit():
-            range_list = [1, range_list[1]]
-        # Malformed cases of x-, where 2nd number missing.  Can't handle this.
-        if not range_list[1].isdigit():
-            raise ValueError(f'Malformed range expression: "{text}"')
-        range_list.sort(key=int)
-        return [*map(str, range(int(range_list[0]), int(range_list[1]) + 1))]
+    '''Return individual numbers for a range expressed as X-Y.
+
+    Compound expressions such as "1-5,9,20-30" are also accepted.  The
+    result is a list of strings; to test membership in or iterate over a
+    large range without creating such a list, use RangeSet.
+    '''
+    if '-' in text or ',' in text:
+        return [*map(str, RangeSet(text))]
     else:
         return text
 
@@ -166,3 +490,190 @@ def pluralized(word, count, include_number=False):
         return f'{intcomma(num)} {text}'
     else:
         return text
+
+
+# Helper functions.
+# .............................................................................
+
+def _flattened_items(original, parent_key, separator):
+    # Dict flattening was originally based on an algorithm by "Nikhil VJ" on
+    # Stack Overflow at https://stackoverflow.com/a/62186294/743730.  Here,
+    # each stack frame holds the key prefix of one level of nesting and an
+    # iterator over the (key, value) pairs remaining at that level.  Lists
+    # are treated as dicts whose keys are the element indexes.
+    stack = [(parent_key, iter(original.items()))]
+    while stack:
+        prefix, items = stack[-1]
+        for key, value in items:
+            new_key = str(prefix) + separator + key if prefix else key
+            if isinstance(value, MutableMapping):
+                if not value.items():
+                    yield (new_key, None)
+                elif isinstance(value, dict):
+                    stack.append((new_key, iter(value.items())))
+                    break
+                else:
+                    # Other kinds of mappings are not flattened.
+                    yield from value.items()
+            elif isinstance(value, Sequence) and not isinstance(value, (str, bytes)):
+                if len(value) > 0:
+                    stack.append((new_key, zip(map(str, range(len(value))), value)))
+                    break
+                else:
+                    yield (new_key, [])
+            else:
+                yield (new_key, value)
+        else:
+            stack.pop()
+
+
+def _flattened_elements(original, separator):
+    # Solution based in part on Stack Overflow posting by "telliott99" on
+    # 2010-01-28 at https://stackoverflow.com/q/2158395/743730.  The stack
+    # holds iterators over the nested sequences being flattened.
+    stack = [iter(original)]
+    while stack:
+        for el in stack[-1]:
+            if isinstance(el, (str, bytes)):
+                yield el
+            elif isinstance(el, Sequence):
+                stack.append(iter(el))
+                break
+            elif isinstance(el, (KeysView, ValuesView)):
+                yield from el
+            else:
+                yield flattened(el, separator=separator)
+        else:
+            stack.pop()
+
+
+_MISSING = object()
+'''Placeholder for values absent from a record in columnized().'''
+
+
+def _as_array(values, mask):
+    present = [value for value, missing in zip(values, mask) if not missing]
+    if present and all(type(value) is int for value in present):
+        if -2**63 <= min(present) and max(present) < 2**63:
+            return array('q', (0 if missing else value
+                               for value, missing in zip(values, mask)))
+    elif present and all(type(value) in (int, float) for value in present):
+        return array('d', (0 if missing else value
+                           for value, missing in zip(values, mask)))
+    return values
+
+
+def _as_numpy(numpy, values, mask):
+    present = [value for value, missing in zip(values, mask) if not missing]
+    for types, dtype in (({int}, numpy.int64), ({int, float}, numpy.float64),
+                         ({bool}, bool)):
+        if present and all(type(value) in types for value in present):
+            try:
+                return numpy.array([0 if missing else value for value, missing
+                                    in zip(values, mask)], dtype=dtype)
+            except OverflowError:
+                break
+    # Assign elements one by one so that NumPy doesn't try to interpret
+    # values that are lists as additional dimensions of the array.
+    result = numpy.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        result[i] = value
+    return result
+
+
+def _plain(value):
+    '''Convert a NumPy scalar to the equivalent Python value.'''
+    return value.item() if hasattr(value, 'item') and hasattr(value, 'dtype') else value
+
+
+def _round_robin(iterable, n):
+    '''Return n iterators that take turns getting the items of iterable.'''
+    source = iter(iterable)
+    queues = [deque() for _ in range(n)]
+    position = [0]
+
+    def take(i):
+        queue = queues[i]
+        while True:
+            if queue:
+                yield queue.popleft()
+                continue
+            try:
+                item = next(source)
+            except StopIteration:
+                return
+            owner = position[0] % n
+            position[0] += 1
+            if owner == i:
+                yield item
+            else:
+                queues[owner].append(item)
+
+    return [take(i) for i in range(n)]
+
+
+def _byte_size(item):
+    if isinstance(item, str):
+        return len(item.encode('utf-8'))
+    if isinstance(item, memoryview):
+        return item.nbytes
+    return len(item)
+
+
+def _mapped_chunk(function, start, chunk):
+    '''Run "function" on the items in "chunk" and return a tuple of the list
+    of results and, if an exception occurred, information about it.'''
+    results = []
+    for offset, item in enumerate(chunk):
+        if interrupted():
+            break
+        try:
+            results.append(function(item))
+        except Exception as ex:                 # noqa PIE786
+            # Tracebacks are not preserved across processes, so send it as text.
+            return results, (start + offset, item, ex, traceback.format_exc())
+    return results, None
+
+
+def _added_to_set(seen):
+    '''Return a function that adds a value to set "seen" and returns True
+    if it was there already.'''
+    def test(value):
+        if value in seen:
+            return True
+        seen.add(value)
+        return False
+    return test
+
+
+def _added_to_window(seen, size):
+    '''Like _added_to_set(), for an OrderedDict limited to "size" entries.'''
+    def test(value):
+        if value in seen:
+            seen.move_to_end(value)
+            return True
+        seen[value] = None
+        if len(seen) > size:
+            seen.popitem(last=False)
+        return False
+    return test
+
+
+def _canonical(value):
+    '''Return a hashable value that is equal for equal unhashable values.'''
+    # Values are tagged with their types so that, e.g., [1, 2] and (1, 2)
+    # (which are not equal) have different canonical forms.
+    if isinstance(value, dict):
+        return (dict, frozenset((k, _canonical(v)) for k, v in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return (set, frozenset(_canonical(v) for v in value))
+    if isinstance(value, (list, tuple)):
+        tag = list if isinstance(value, list) else tuple
+        return (tag, tuple(_canonical(v) for v in value))
+    if isinstance(value, bytearray):
+        return (bytearray, bytes(value))
+    try:
+        hash(value)
+    except TypeError:
+        return (type(value), repr(value))
+    return value
@@ -52,6 +52,18 @@ class RateLimitExceeded(CommonPyException):
     '''The service flagged reports that its rate limits have been exceeded.'''
 
 
+class ResponseTooLarge(CommonPyException):
+    '''The response from a service exceeded the maximum size allowed.'''
+
+
+class TransferStalled(CommonPyException):
+    '''A network transfer fell below the minimum rate allowed.'''
+
+
+class TaskFailure(CommonPyException):
+    '''A function run on an item by parallel_map(...) raised an exception.'''
+
+
 class ArgumentError(CommonPyException):
     '''Incorrect or invalid argument or argument value.'''
 
@@ -14,25 +14,102 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
+from   collections import namedtuple
+from   concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from   contextlib import contextmanager, suppress
+import errno
+from   fnmatch import translate
+import gzip
+import hashlib
+import io
+import json
+from   functools import lru_cache
+import mmap
 import os
-from   os.path import exists, isdir, isfile, join, dirname, relpath, realpath
+from   os.path import exists, isdir, join, dirname, relpath, realpath
 from   os.path import splitext
+import queue
+import re
+import select
 import shutil
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
+from   time import localtime, monotonic
+import uuid
 import webbrowser
+import zipfile
 
 if __debug__:
     from sidetrack import log
 
+from .interrupt import interrupted
+
+
+# Internal constants.
+# .............................................................................
+
+_HASH_BLOCK_SIZE = 1024 * 1024
+'''Number of bytes read at a time when computing file hashes.'''
+
+_COPY_BLOCK_SIZE = 8 * 1024 * 1024
+'''Maximum number of bytes copied per system call when copying files.'''
+
+_FICLONE = 0x40049409
+'''Linux ioctl request code for cloning a file (from <linux/fs.h>).'''
+
+_TRASH_PREFIX = '.commonpy-trash-'
+'''Prefix of the names of directories being deleted in the background.'''
+
+_INOTIFY_MASK = (0x00000002    # IN_MODIFY
+                 | 0x00000008  # IN_CLOSE_WRITE
+                 | 0x00000040  # IN_MOVED_FROM
+                 | 0x00000080  # IN_MOVED_TO
+                 | 0x00000100  # IN_CREATE
+                 | 0x00000200  # IN_DELETE
+                 | 0x00000400  # IN_DELETE_SELF
+                 | 0x01000000)  # IN_ONLYDIR
+'''Events requested from inotify for each watched directory.'''
+
+_WATCH_BATCH_BYTES = 1024 * 1024
+'''Most inotify data that DirectoryWatcher.read(...) collects in one batch.'''
+
+_PREFETCH_LIMIT = 1024 * 1024
+'''Files up to this size are read in full by the archive reader threads.'''
+
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                    errno.ENOTTY, errno.EBADF, errno.EPERM, errno.ENOTSUP}
+'''Error codes indicating that a copying mechanism isn't supported here.'''
+
+
+# Global variables.
+# .............................................................................
+
+_trash_in_progress = set()
+'''Paths of directories being deleted in the background by this process.'''
+
+_trash_lock = threading.Lock()
+'''Lock for accessing _trash_in_progress.'''
+
+_DELETE_BATCH = 256
+'''Number of files unlinked by each task of a background deletion.'''
+
+_metadata_local = threading.local()
+'''Per-thread state: the cache of file metadata in effect, if any.'''
+
 
 # Main functions.
 # .............................................................................
 
 def readable(dest):
     '''Returns True if the given 'dest' is accessible and readable.'''
-    return os.access(dest, os.F_OK | os.R_OK)
+    path = os.fspath(dest)
+    return _cached(('access', path), lambda: os.access(path, os.F_OK | os.R_OK))
 
 
 def writable(dest):
@@ -49,37 +126,188 @@ def writable(dest):
             return False
         return True
 
-    if exists(dest) and not isdir(dest):
+    path = os.fspath(dest)
+    st = _stat(path)
+    if st and not stat.S_ISDIR(st.st_mode):
         # Path is an existing file.
-        return os.access(dest, os.F_OK | os.W_OK)
-    elif isdir(dest):
-        # Path itself is an existing directory.  Is it writable?
-        return dir_writable(dest)
+        return _cached(('writable', path), lambda: os.access(path, os.F_OK | os.W_OK))
     else:
-        # Path is a file but doesn't exist yet. Can we write to the parent dir?
-        return dir_writable(dirname(dest))
+        # If path is an existing directory, test it; otherwise, path is a file
+        # that doesn't exist yet, so test whether we can write to the parent.
+        directory = path if st else dirname(path)
+        return _cached(('dir writable', directory), lambda: dir_writable(directory))
 
 
 def nonempty(dest):
     '''Returns True if the file is not empty.'''
-    return os.stat(dest).st_size != 0
+    st = _stat(os.fspath(dest))
+    if st is None:
+        # Let os.stat() raise the appropriate exception.
+        st = os.stat(dest)
+    return st.st_size != 0
+
+
+def readable_paths(paths):
+    '''Returns a list of the results of readable(...) for each of 'paths'.'''
+    return _batch(readable, paths)
+
+
+def writable_paths(paths):
+    '''Returns a list of the results of writable(...) for each of 'paths'.'''
+    return _batch(writable, paths)
+
+
+def nonempty_paths(paths):
+    '''Returns a list of the results of nonempty(...) for each of 'paths'.
+    Unlike nonempty(...), this returns False for paths that don't exist.'''
+    def test(path):
+        try:
+            return nonempty(path)
+        except OSError:
+            return False
+    return _batch(test, paths)
+
+
+@contextmanager
+def metadata_cache(ttl=None):
+    '''Context manager that caches file metadata used by functions here.
+
+    Within the "with" statement, the results of the system calls made by
+    readable(...), writable(...), nonempty(...), and the directory-walking
+    functions such as files_in_directory(...) are remembered and reused, so
+    that checking the same paths or directories repeatedly costs nothing
+    extra.  This is meant for validation passes over many paths during which
+    the files are not expected to change.  If 'ttl' is not None, cached
+    values are discarded after 'ttl' seconds.  The value of the context is
+    an object with a method clear() that discards all cached values.  The
+    cache is in effect only in the thread that entered the "with" statement
+    (and in the worker threads that functions here use on its behalf), so
+    other threads are not affected.  The functions readable_paths(...),
+    writable_paths(...), and nonempty_paths(...) use a cache automatically.
+    '''
+    previous = _current_cache()
+    _metadata_local.cache = _MetadataCache(ttl)
+    try:
+        yield _metadata_local.cache
+    finally:
+        _metadata_local.cache = previous
 
 
 def files_in_directory(directory, extensions=None, recursive=True):
-    if not isdir(directory):
-        return []
-    if not readable(directory):
-        return []
-    if __debug__: log(f'reading directory {directory}')
-    files = []
-    for item in os.listdir(directory):
-        full_path = join(directory, item)
-        if isfile(full_path) and readable(full_path):
-            if not extensions or filename_extension(item) in extensions:
-                files.append(full_path)
-        elif isdir(full_path) and recursive:
-            files += files_in_directory(full_path, extensions)
-    return sorted(files)
+    '''Returns a sorted list of the readable files in 'directory'.
+
+    If 'extensions' is given, only files whose extensions (as returned by
+    filename_extension(...)) are in 'extensions' are included.  If
+    'recursive' is True, subdirectories are searched too.  This is a wrapper
+    around iter_files(...).
+    '''
+    return list(iter_files(directory, extensions, recursive, sort=True))
+
+
+def iter_files(directory, extensions=None, recursive=True, patterns=None,
+               max_depth=None, sort=False):
+    '''Yields the paths of the readable files in 'directory'.
+
+    Files are yielded as they are found, one directory at a time.  If
+    'extensions' is given, only files whose extensions (as returned by
+    filename_extension(...)) are in 'extensions' are included.  If 'patterns'
+    is given, only files whose names match at least one of the glob-style
+    patterns (e.g., "*.jp*g") are included.  If 'recursive' is True,
+    subdirectories are searched too, down to 'max_depth' levels below
+    'directory' if 'max_depth' is not None (0 means 'directory' only).
+
+    Instead of a list of extensions, 'extensions' can be a FileMatcher object
+    (which is more efficient if the same test is used repeatedly).
+
+    If 'sort' is True, the paths are collected and yielded in sorted order;
+    this means nothing is yielded until the whole tree has been read.
+    Directories that cannot be read are skipped.
+    '''
+    if sort:
+        yield from sorted(iter_files(directory, extensions, recursive,
+                                     patterns, max_depth))
+        return
+    wanted = _file_filter(extensions, patterns)
+    pending = [(directory, 0)]
+    while pending:
+        path, depth = pending.pop()
+        files, subdirs = _scanned(path, wanted)
+        yield from files
+        if recursive and (max_depth is None or depth < max_depth):
+            pending.extend((subdir, depth + 1) for subdir in reversed(subdirs))
+
+
+def iter_files_parallel(directory, extensions=None, recursive=True,
+                        patterns=None, max_depth=None, workers=8, ordered=False):
+    '''Yields the paths of the readable files in 'directory', reading
+    several directories at the same time using a pool of 'workers' threads.
+
+    This takes the same filtering arguments as iter_files(...), and is meant
+    for file systems such as NFS or SMB where reading a directory involves a
+    network round trip.  By default, files are yielded as soon as any
+    directory has been read, so the order varies from one run to the next.
+    If 'ordered' is True, the order is deterministic: directories are visited
+    depth-first in sorted order, and the files in each directory are yielded
+    in sorted order (subdirectories are still read ahead in parallel).  At
+    most 'workers' * 4 directories are read ahead at any time.
+    '''
+    wanted = _file_filter(extensions, patterns)
+    cache = _current_cache()
+
+    def scanned(path):
+        return _scanned_with_cache(cache, path, wanted)
+
+    def descend(depth):
+        return recursive and (max_depth is None or depth < max_depth)
+
+    # Directories waiting to be read are kept as paths, and only a limited
+    # number are read ahead, so that memory use doesn't grow with the tree.
+    limit = workers * 4
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if ordered:
+            # Stack of [path, depth, future], with the next directory on top.
+            stack = [[directory, 0, None]]
+            submitted = 0
+            try:
+                while stack:
+                    for item in reversed(stack):
+                        if submitted >= limit:
+                            break
+                        if item[2] is None:
+                            item[2] = executor.submit(scanned, item[0])
+                            submitted += 1
+                    path, depth, future = stack.pop()
+                    if future is None:
+                        future = executor.submit(scanned, path)
+                    else:
+                        submitted -= 1
+                    files, subdirs = future.result()
+                    if descend(depth):
+                        stack.extend([subdir, depth + 1, None]
+                                     for subdir in sorted(subdirs, reverse=True))
+                    yield from sorted(files)
+            finally:
+                for _, _, future in stack:
+                    if future:
+                        future.cancel()
+        else:
+            waiting = [(directory, 0)]
+            pending = {}
+            try:
+                while waiting or pending:
+                    while waiting and len(pending) < limit:
+                        path, depth = waiting.pop()
+                        pending[executor.submit(scanned, path)] = depth
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        depth = pending.pop(future)
+                        files, subdirs = future.result()
+                        if descend(depth):
+                            waiting.extend((subdir, depth + 1) for subdir in subdirs)
+                        yield from files
+            finally:
+                for future in pending:
+                    future.cancel()
 
 
 def filename_basename(file):
@@ -106,14 +334,21 @@ def alt_extension(filepath, ext):
 
 
 def filtered_by_extensions(item_list, endings):
+    '''Returns the items in 'item_list' that do not contain any of 'endings'.
+
+    An item is left out if any of the strings in 'endings' appears anywhere
+    in the lower-cased item.  Alternatively, 'endings' can be a FileMatcher
+    object, in which case the items it matches are left out.  The list is
+    scanned once, regardless of the number of endings.
+    '''
     if not item_list:
         return []
     if not endings:
         return item_list
-    results = item_list
-    for ending in endings:
-        results = list(filter(lambda name: ending not in name.lower(), results))
-    return results
+    if isinstance(endings, FileMatcher):
+        return [item for item in item_list if not endings(item)]
+    found = _substrings_regex(tuple(endings)).search
+    return [item for item in item_list if not found(item.lower())]
 
 
 def relative(file):
@@ -121,12 +356,7 @@ def relative(file):
     relative path would require more than one parent step (i.e., ../../*
     instead of ../*) then it will return an absolute path instead.  If the
     argument is actuall a file path, it will return it unchanged.'''
-
-    # Validator_collection takes a long time to load.  Delay loading it until
-    # it's actually needed, so that application startup times can be faster.
-    from validator_collection.checkers import is_url
-
-    if is_url(file):
+    if _url_like(file):
         return file
     try:
         # This can fail on Windows if we're on a network-mapped drive.
@@ -140,6 +370,42 @@ def relative(file):
             return realpath(candidate)
 
 
+def relative_paths(files):
+    '''Returns a list of the results of relative(...) for each of 'files'.
+
+    This is much faster than calling relative(...) on each path when there
+    are many paths: the current directory is looked up once, and the
+    relative form of each parent directory is computed only once.
+    '''
+    cwd = os.getcwd()
+    parents = {}
+    results = []
+    for file in files:
+        if _url_like(file):
+            results.append(file)
+            continue
+        directory, name = os.path.split(file)
+        if not directory or name in ('', '.', '..'):
+            candidate = _relpath_or_none(file, cwd)
+        else:
+            if directory not in parents:
+                parents[directory] = _relpath_or_none(directory, cwd)
+            parent = parents[directory]
+            if parent is None:
+                candidate = None
+            elif parent == '.':
+                candidate = name
+            else:
+                candidate = join(parent, name)
+        if candidate is None:
+            results.append(file)
+        elif candidate.startswith('../..'):
+            results.append(realpath(candidate))
+        else:
+            results.append(candidate)
+    return results
+
+
 def rename_existing(file):
     '''Renames 'file' to 'file.bak'.'''
 
@@ -166,10 +432,33 @@ def rename_existing(file):
         return
 
 
-def delete_existing(file):
-    '''Delete the given file.'''
-    # Check if it's actually a directory.
-    if isdir(file):
+def delete_existing(file, background=False, workers=4):
+    '''Delete the given file.
+
+    If 'file' is a directory and 'background' is True, the directory is first
+    renamed to a hidden name in the same parent directory (which is quick and
+    atomic), and then its contents are deleted in the background by a pool of
+    'workers' threads.  In that case, this function returns right away with a
+    concurrent.futures.Future object that completes when the deletion is
+    done.  Any leftover hidden directories from earlier background deletions
+    that did not finish (e.g., because the program crashed) are deleted at the
+    same time; see also purge_trash(...).  In all other cases, this function
+    returns None after the deletion is done.
+    '''
+    # Check if it's actually a directory.  Links to directories are deleted
+    # like files, so that the directories they point to are left alone.
+    real_dir = isdir(file) and not os.path.islink(file)
+    if real_dir and background:
+        parent = dirname(os.path.abspath(file))
+        trash = join(parent, f'{_TRASH_PREFIX}{os.getpid()}-{uuid.uuid4().hex}')
+        try:
+            os.rename(file, trash)
+        except OSError:
+            if __debug__: log(f'unable to rename {file}; deleting it in the foreground')
+        else:
+            if __debug__: log(f'renamed {file} to {trash} for background deletion')
+            return _deleted_in_background(trash, workers)
+    if real_dir:
         if __debug__: log(f'doing rmtree on directory {file}')
         try:
             shutil.rmtree(file)
@@ -184,6 +473,39 @@ def delete_existing(file):
         os.remove(file)
 
 
+def purge_trash(directory, workers=4):
+    '''Delete leftovers of background deletions in 'directory'.
+
+    When delete_existing(...) is called with background = True, it renames
+    directories to hidden names before deleting them.  If the program stops
+    before a deletion is finished, the renamed directory is left behind; this
+    function deletes such leftovers in 'directory' (except those that belong
+    to deletions still in progress) and returns the number found.
+    '''
+    count = 0
+    try:
+        with os.scandir(directory) as entries:
+            leftovers = [e.path for e in entries if e.name.startswith(_TRASH_PREFIX)]
+    except OSError:
+        return 0
+    for path in leftovers:
+        with _trash_lock:
+            if path in _trash_in_progress or _trash_owner_alive(path):
+                continue
+            _trash_in_progress.add(path)
+        try:
+            if __debug__: log(f'deleting leftover trash {path}')
+            if os.path.islink(path) or not isdir(path):
+                os.unlink(path)
+            else:
+                _removed_tree(path, workers)
+            count += 1
+        finally:
+            with _trash_lock:
+                _trash_in_progress.discard(path)
+    return count
+
+
 def file_in_use(file):
     '''Returns True if the given 'file' appears to be in use.  Note: this only
     works on Windows, currently.
@@ -201,9 +523,35 @@ def file_in_use(file):
 
 
 def copy_file(src, dst):
-    '''Copies a file from "src" to "dst".'''
+    '''Copies a file from "src" to "dst" and returns the method used.
+
+    As with shutil.copy2(), "dst" can be a directory, and the permission bits
+    and timestamps of "src" are copied too.  On Linux, this tries the fastest
+    mechanism supported by the file system, in this order:
+
+      1. "reflink": clone the file using the FICLONE ioctl, which shares the
+         data blocks on copy-on-write file systems such as Btrfs and XFS
+      2. "copy_file_range": copy the data within the kernel
+      3. "sendfile": copy the data within the kernel using sendfile()
+      4. "copy": read and write the data in user space
+
+    Methods 2-4 copy only the regions of "src" that contain data, so sparse
+    files stay sparse.  On other platforms, this uses shutil.copy2() and
+    returns "copy2".  The return value is the name of the method used.
+    '''
     if __debug__: log(f'copying file {src} to {dst}')
-    shutil.copy2(src, dst, follow_symlinks=True)
+    if not sys.platform.startswith('linux'):
+        shutil.copy2(src, dst, follow_symlinks=True)
+        return 'copy2'
+    if isdir(dst):
+        dst = join(dst, os.path.basename(src))
+    if exists(dst) and os.path.samefile(src, dst):
+        raise shutil.SameFileError(f'{src} and {dst} are the same file')
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        method = _copied_data(fsrc.fileno(), fdst.fileno())
+    shutil.copystat(src, dst, follow_symlinks=True)
+    if __debug__: log(f'copied {src} using {method}')
+    return method
 
 
 def open_file(file):
@@ -223,3 +571,1676 @@ def open_url(url):
     default approach.'''
     if __debug__: log(f'opening url {url}')
     webbrowser.open(url)
+
+
+# File name matching.
+# .............................................................................
+
+class FileMatcher():
+    '''Compiled test for whether file names have given extensions or patterns.
+
+    A FileMatcher is created from a list of file name 'extensions' (such as
+    ".txt" or ".tar.gz", compared without regard to case) and/or a list of
+    glob-style 'patterns' (such as "*.jp*g").  Calling the object on a path
+    returns True if the last component of the path has one of the extensions
+    (if any were given) and matches one of the patterns (if any were given).
+    The extensions are kept in a set and the patterns are combined into one
+    regular expression, so the cost of a test does not grow with the number
+    of extensions, and the object can be reused for any number of tests.
+    FileMatcher objects can be given to iter_files(...) and related functions
+    in place of a list of extensions, and to filtered_by_extensions(...).
+    '''
+
+    def __init__(self, extensions=None, patterns=None):
+        self._extensions = frozenset(ext.lower() for ext in (extensions or []))
+        self._multipart = any(ext.count('.') > 1 for ext in self._extensions)
+        self._regex = None
+        if patterns:
+            regex = '|'.join(f'(?:{translate(pattern)})' for pattern in patterns)
+            self._regex = re.compile(regex, 0 if os.path.normcase('A') == 'A' else re.IGNORECASE)
+
+
+    def __call__(self, path):
+        name = os.path.basename(path)
+        if self._extensions and not self._has_extension(name):
+            return False
+        return self._regex is None or self._regex.match(name) is not None
+
+
+    def _has_extension(self, name):
+        if not self._multipart:
+            return filename_extension(name) in self._extensions
+        lowered = name.lower()
+        position = lowered.find('.', 1)
+        while position > 0:
+            if lowered[position:] in self._extensions:
+                return True
+            position = lowered.find('.', position + 1)
+        return False
+
+
+    def matches(self, path):
+        '''Returns True if 'path' passes the tests of this matcher.'''
+        return self(path)
+
+
+    def matching(self, paths):
+        '''Yields the items of the iterable 'paths' that pass the tests.'''
+        return filter(self, paths)
+
+
+# Directory snapshots.
+# .............................................................................
+
+SnapshotDiff = namedtuple('SnapshotDiff', 'added removed modified')
+SnapshotDiff.__doc__ = '''Sorted lists of the paths of files that were added,
+removed, and modified between two DirectorySnapshot objects.'''
+
+
+class DirectorySnapshot():
+    '''Record of the files in a directory tree, used to find what changed.
+
+    A snapshot stores the size, modification time, and inode number of each
+    file in the tree, along with the modification time of each directory.
+    Create one using DirectorySnapshot.scan(directory), save it to a file
+    using save(path), read it back using DirectorySnapshot.load(path), and
+    compare two snapshots using diff(...).  The function changed_files(...)
+    combines these steps.
+
+    When scan(...) is given a previous snapshot, it avoids re-reading
+    directories that have not changed since then.  A directory's modification
+    time changes when files are added, removed or renamed in it, but not when
+    an existing file is rewritten, so by default this only saves listing the
+    directory: the files in it are still checked with stat().  If the caller
+    knows that files are only ever added or replaced (not rewritten in place),
+    'trust_dir_mtime' = True skips unchanged directories entirely, making the
+    cost of a rescan proportional to the number of directories and changes.
+    Symbolic links to directories are not followed.
+    '''
+
+    def __init__(self, directory, dirs=None):
+        self.directory = str(directory)
+        # Map of relative directory path -> [mtime_ns, files, subdirs], where
+        # files maps file names to [size, mtime_ns, inode].
+        self._dirs = dirs or {}
+
+
+    @classmethod
+    def scan(cls, directory, previous=None, trust_dir_mtime=False):
+        '''Scan 'directory' and return a new DirectorySnapshot.'''
+        directory = str(directory)
+        old_dirs = previous._dirs if previous else {}
+        dirs = {}
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            path = join(directory, rel) if rel else directory
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            old = old_dirs.get(rel)
+            if old and trust_dir_mtime and old[0] == mtime:
+                dirs[rel] = old
+            elif old and old[0] == mtime:
+                files = {}
+                for name in old[1]:
+                    try:
+                        st = os.stat(join(path, name))
+                        files[name] = [st.st_size, st.st_mtime_ns, st.st_ino]
+                    except OSError:
+                        continue
+                dirs[rel] = [mtime, files, old[2]]
+            else:
+                dirs[rel] = [mtime] + cls._listing(path)
+            pending.extend(join(rel, subdir) if rel else subdir for subdir in dirs[rel][2])
+        return cls(directory, dirs)
+
+
+    @staticmethod
+    def _listing(path):
+        files = {}
+        subdirs = []
+        try:
+            if __debug__: log(f'reading directory {path}')
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        elif entry.is_file():
+                            st = entry.stat()
+                            files[entry.name] = [st.st_size, st.st_mtime_ns, st.st_ino]
+                    except OSError:
+                        continue
+        except OSError as ex:
+            if __debug__: log(f'unable to read directory {path}: {ex}')
+        return [files, subdirs]
+
+
+    @classmethod
+    def load(cls, path):
+        '''Read a DirectorySnapshot from the file 'path' written by save().'''
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['directory'], data['dirs'])
+
+
+    def save(self, path):
+        '''Write this snapshot to the file 'path' (replacing it atomically).'''
+        data = {'version': 1, 'directory': self.directory, 'dirs': self._dirs}
+        tmp = path + '.tmp'
+        with gzip.open(tmp, 'wt', encoding='utf-8', compresslevel=6) as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp, path)
+        if __debug__: log(f'saved snapshot of {self.directory} to {path}')
+
+
+    def files(self):
+        '''Return a dict mapping file paths to (size, mtime_ns, inode).'''
+        return {join(self.directory, rel, name): tuple(info)
+                for rel, (_, files, _) in self._dirs.items()
+                for name, info in files.items()}
+
+
+    def diff(self, newer):
+        '''Return a SnapshotDiff describing changes from this snapshot to the
+        snapshot 'newer'.  A file counts as modified if its size, modification
+        time, or inode number (e.g., because it was replaced) changed.'''
+        old = self.files()
+        new = newer.files()
+        added = sorted(path for path in new if path not in old)
+        removed = sorted(path for path in old if path not in new)
+        modified = sorted(path for path, info in new.items()
+                          if path in old and old[path] != info)
+        return SnapshotDiff(added, removed, modified)
+
+
+def changed_files(directory, index_file, trust_dir_mtime=False):
+    '''Return a SnapshotDiff of the changes in 'directory' since the last call.
+
+    The state of the directory tree is kept in 'index_file', which is updated
+    by each call.  On the first call (when 'index_file' does not exist), all
+    files are reported as added.  See DirectorySnapshot for the meaning of
+    'trust_dir_mtime'.
+    '''
+    previous = None
+    if exists(index_file):
+        previous = DirectorySnapshot.load(index_file)
+        if previous.directory != str(directory):
+            if __debug__: log(f'ignoring snapshot of {previous.directory}')
+            previous = None
+    current = DirectorySnapshot.scan(directory, previous, trust_dir_mtime)
+    current.save(index_file)
+    return (previous or DirectorySnapshot(directory)).diff(current)
+
+
+# File hashing.
+# .............................................................................
+
+ManifestCheck = namedtuple('ManifestCheck', 'mismatched missing')
+ManifestCheck.__doc__ = '''Result of verify_manifest(): sorted lists of the paths
+of files whose hashes did not match the manifest, and of files that are
+listed in the manifest but do not exist.'''
+
+
+class HashCache():
+    '''Persistent cache of file hashes, kept in an SQLite database file.
+
+    Hashes are stored under a key made from the device, inode number, size,
+    and modification time (in nanoseconds) of a file, plus the name of the
+    hash algorithm, so that a cached value is used only if the file appears
+    not to have changed since it was hashed.  The cache is meant to be given
+    to file_hashes(...) and the other hashing functions in this module.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS hashes (
+                                  dev INTEGER, ino INTEGER, size INTEGER,
+                                  mtime INTEGER, algorithm TEXT, digest TEXT,
+                                  PRIMARY KEY (dev, ino, size, mtime, algorithm))''')
+
+
+    @staticmethod
+    def _key(st, algorithm):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, algorithm)
+
+
+    def get(self, st, algorithm):
+        '''Return the digest for the file with os.stat() result 'st', or None.'''
+        with self._lock:
+            row = self._db.execute('SELECT digest FROM hashes WHERE dev = ? AND'
+                                   ' ino = ? AND size = ? AND mtime = ? AND'
+                                   ' algorithm = ?', self._key(st, algorithm)).fetchone()
+        return row[0] if row else None
+
+
+    def put_many(self, entries, algorithm):
+        '''Store digests from an iterable of (os.stat() result, digest) pairs.'''
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                                 (self._key(st, algorithm) + (digest,)
+                                  for st, digest in entries))
+
+
+    def close(self):
+        '''Close the database file.'''
+        self._db.close()
+
+
+def file_hash(file, algorithm='sha256'):
+    '''Returns the hex digest of the contents of 'file' using 'algorithm'.
+
+    The value of 'algorithm' can be any name accepted by hashlib.new().
+    '''
+    hasher = hashlib.new(algorithm)
+    buffer = bytearray(_HASH_BLOCK_SIZE)
+    view = memoryview(buffer)
+    with open(file, 'rb', buffering=0) as f:
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            hasher.update(view[:count])
+    return hasher.hexdigest()
+
+
+def file_hashes(files, algorithm='sha256', workers=4, cache=None):
+    '''Returns a dict mapping each path in 'files' to the hex digest of its
+    contents, computed using 'algorithm'.
+
+    Files are hashed in parallel using a pool of 'workers' threads.  (The
+    hashlib functions release the Python global interpreter lock while they
+    work, so threads are effective here.)  If 'cache' is a HashCache object,
+    files that are unchanged since they were last hashed are not read again,
+    and newly-computed hashes are added to the cache.  Paths that cannot be
+    read are left out of the result.
+    '''
+    results = {}
+    todo = []
+    for file in files:
+        try:
+            st = os.stat(file)
+        except OSError as ex:
+            if __debug__: log(f'unable to stat {file}: {ex}')
+            continue
+        digest = cache.get(st, algorithm) if cache else None
+        if digest:
+            results[file] = digest
+        else:
+            todo.append((file, st))
+    if __debug__: log(f'hashing {len(todo)} files ({len(results)} found in cache)')
+
+    def hashed(file):
+        try:
+            return file_hash(file, algorithm)
+        except OSError as ex:
+            if __debug__: log(f'unable to hash {file}: {ex}')
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        digests = list(executor.map(hashed, [file for file, _ in todo]))
+    new_entries = [(st, digest) for (_, st), digest in zip(todo, digests) if digest]
+    results.update((file, digest) for (file, _), digest in zip(todo, digests) if digest)
+    if cache and new_entries:
+        cache.put_many(new_entries, algorithm)
+    return results
+
+
+def write_manifest(directory, manifest_file, algorithm='sha256', workers=4,
+                   cache=None):
+    '''Writes a manifest of the hashes of the files in 'directory'.
+
+    The manifest has one line per file, in the format used by programs such
+    as sha256sum (the hex digest, two spaces, and the path of the file
+    relative to 'directory', using forward slashes), sorted by path.  The
+    manifest file itself is left out if it is inside 'directory'.  The
+    arguments 'algorithm', 'workers', and 'cache' are as for file_hashes(...).
+    Returns the number of files listed.
+    '''
+    files = [f for f in iter_files(directory)
+             if realpath(f) != realpath(manifest_file)]
+    digests = file_hashes(files, algorithm, workers, cache)
+    lines = sorted((relpath(f, directory).replace(os.sep, '/'), digest)
+                   for f, digest in digests.items())
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        f.writelines(f'{digest}  {path}\n' for path, digest in lines)
+    return len(lines)
+
+
+def verify_manifest(manifest_file, directory=None, algorithm='sha256',
+                    workers=4, cache=None):
+    '''Checks the files listed in 'manifest_file' against their hashes.
+
+    The manifest must be in the format written by write_manifest(...).  Paths
+    in the manifest are taken to be relative to 'directory', which defaults
+    to the directory containing the manifest.  Returns a ManifestCheck object
+    whose lists are empty if all the files are present and match.
+    '''
+    directory = directory if directory is not None else dirname(manifest_file)
+    expected = {}
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            digest, _, path = line.rstrip('\n').partition('  ')
+            if path:
+                expected[join(directory, *path.split('/'))] = digest.lower()
+    actual = file_hashes(expected, algorithm, workers, cache)
+    missing = sorted(path for path in expected if path not in actual)
+    mismatched = sorted(path for path, digest in actual.items()
+                        if digest != expected[path])
+    return ManifestCheck(mismatched, missing)
+
+
+def duplicate_files(files, algorithm='sha256', workers=4, cache=None):
+    '''Returns a list of groups of paths in 'files' with identical contents.
+
+    Each group is a sorted list of two or more paths, and the groups are
+    sorted by their first path.  Only files that have the same size as some
+    other file are hashed.  The arguments 'algorithm', 'workers', and 'cache'
+    are as for file_hashes(...).
+    '''
+    by_size = {}
+    for file in files:
+        try:
+            by_size.setdefault(os.stat(file).st_size, []).append(file)
+        except OSError:
+            continue
+    candidates = [f for group in by_size.values() if len(group) > 1 for f in group]
+    by_digest = {}
+    for file, digest in file_hashes(candidates, algorithm, workers, cache).items():
+        by_digest.setdefault(digest, []).append(file)
+    return sorted(sorted(group) for group in by_digest.values() if len(group) > 1)
+
+
+# Copying directory trees.
+# .............................................................................
+
+CopiedFile = namedtuple('CopiedFile', 'src dst action size method error')
+CopiedFile.__doc__ = '''Result for one file in copy_tree() or sync_tree().
+
+The field "action" is one of "copied", "skipped" (the destination was
+already up to date), "failed", or "deleted" (by sync_tree()).  The field
+"method" is the value returned by copy_file(), and "error" is the exception
+raised if the action is "failed".'''
+
+
+class TreeCopyReport(namedtuple('TreeCopyReport', 'files elapsed interrupted')):
+    '''Summary of copy_tree() or sync_tree(): a list of CopiedFile objects,
+    the time taken in seconds, and whether the operation was interrupted.'''
+
+    def _with_action(self, action):
+        return [f for f in self.files if f.action == action]
+
+    @property
+    def copied(self):
+        return self._with_action('copied')
+
+    @property
+    def skipped(self):
+        return self._with_action('skipped')
+
+    @property
+    def failed(self):
+        return self._with_action('failed')
+
+    @property
+    def size(self):
+        '''Total number of bytes copied.'''
+        return sum(f.size for f in self.files if f.action == 'copied')
+
+    @property
+    def throughput(self):
+        '''Average number of bytes per second copied.'''
+        return self.size / self.elapsed if self.elapsed > 0 else 0
+
+
+def copy_tree(src, dst, workers=8, compare='stat', skip_unchanged=True):
+    '''Copies the directory tree 'src' to 'dst' and returns a TreeCopyReport.
+
+    The directories of 'src' are created in 'dst' first, and then the files
+    are copied using copy_file(...) by a pool of 'workers' threads.  If
+    'skip_unchanged' is True, files whose destination already matches are not
+    copied again.  Parameter 'compare' determines how matches are found: with
+    "stat" (the default), the files must have the same size and modification
+    time (to within 1 second); with "hash", they must have the same size and
+    SHA-256 hash.  Files and directories that cannot be copied are reported
+    as failed, and the rest of the files are still copied.  Symbolic links are never
+    followed: a link in 'src' is copied as a link, and a link in 'dst' is
+    replaced rather than written through.
+
+    If interrupt() is called (see the interrupt module), no new copies are
+    started, copies in progress are allowed to finish, and the report is
+    returned with its "interrupted" field set to True.
+    '''
+    if compare not in ['stat', 'hash']:
+        raise ValueError('Value of compare must be "stat" or "hash".')
+    start = monotonic()
+    dirs, files, links = _tree_contents(src)
+    link_set = set(links)
+    results = []
+    os.makedirs(dst, exist_ok=True)
+    for rel in dirs:
+        path = join(dst, rel)
+        try:
+            # Don't create directories (and then files) through a link in 'dst'.
+            if os.path.islink(path):
+                os.remove(path)
+            os.makedirs(path, exist_ok=True)
+        except OSError as ex:
+            if __debug__: log(f'failed to create directory {path}: {ex}')
+            results.append(CopiedFile(join(src, rel), path, 'failed', 0, None, ex))
+    if __debug__: log(f'created {len(dirs)} directories in {dst}')
+
+    def unchanged(source, dest):
+        try:
+            dest_stat = os.stat(dest)
+        except OSError:
+            return False
+        source_stat = os.stat(source)
+        if source_stat.st_size != dest_stat.st_size:
+            return False
+        if compare == 'stat':
+            return abs(source_stat.st_mtime - dest_stat.st_mtime) < 1
+        return file_hash(source) == file_hash(dest)
+
+    def process(rel):
+        source = join(src, rel)
+        dest = join(dst, rel)
+        try:
+            if rel in link_set:
+                target = os.readlink(source)
+                if os.path.islink(dest) and os.readlink(dest) == target:
+                    return CopiedFile(source, dest, 'skipped', 0, None, None)
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                os.symlink(target, dest)
+                return CopiedFile(source, dest, 'copied', 0, 'symlink', None)
+            if os.path.islink(dest):
+                # Replace the link itself instead of writing to its target.
+                os.remove(dest)
+            elif skip_unchanged and unchanged(source, dest):
+                return CopiedFile(source, dest, 'skipped', 0, None, None)
+            method = copy_file(source, dest)
+            return CopiedFile(source, dest, 'copied', os.stat(dest).st_size, method, None)
+        except OSError as ex:
+            if __debug__: log(f'failed to copy {source}: {ex}')
+            return CopiedFile(source, dest, 'failed', 0, None, ex)
+
+    stopped = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = set()
+        for rel in files + links:
+            if interrupted():
+                stopped = True
+                break
+            in_flight.add(executor.submit(process, rel))
+            if len(in_flight) >= workers * 4:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                results.extend(future.result() for future in done)
+        results.extend(future.result() for future in wait(in_flight)[0])
+    report = TreeCopyReport(results, monotonic() - start, stopped)
+    if __debug__: log(f'copied {len(report.copied)} files ({report.size} bytes) and'
+                      f' skipped {len(report.skipped)} from {src} to {dst}')
+    return report
+
+
+def sync_tree(src, dst, workers=8, compare='stat'):
+    '''Makes the directory tree 'dst' a copy of 'src' and returns a report.
+
+    This is like copy_tree(...), except that files and directories in 'dst'
+    that do not exist in 'src' are deleted afterwards (and reported with the
+    action "deleted").  Nothing is deleted if the copy was interrupted.
+    '''
+    report = copy_tree(src, dst, workers, compare)
+    if report.interrupted:
+        return report
+    src_dirs, src_files, src_links = _tree_contents(src)
+    dst_dirs, dst_files, dst_links = _tree_contents(dst)
+    deleted = []
+    # Links are removed themselves; the walk never descends into them.
+    for rel in sorted(set(dst_files + dst_links) - set(src_files + src_links)):
+        path = join(dst, rel)
+        try:
+            os.remove(path)
+            deleted.append(CopiedFile(None, path, 'deleted', 0, None, None))
+        except OSError as ex:
+            deleted.append(CopiedFile(None, path, 'failed', 0, None, ex))
+    # Remove deeper directories first, so that parents are empty.
+    for rel in sorted(set(dst_dirs) - set(src_dirs), reverse=True):
+        try:
+            os.rmdir(join(dst, rel))
+        except OSError as ex:
+            if __debug__: log(f'unable to remove directory {join(dst, rel)}: {ex}')
+    return report._replace(files=report.files + deleted)
+
+
+# Directory watching.
+# .............................................................................
+
+FileEvent = namedtuple('FileEvent', 'kind path is_dir dest')
+FileEvent.__doc__ = '''A change reported by DirectoryWatcher.
+
+The field "kind" is one of "created", "modified", "deleted", "moved", or
+"rescan".  For "moved" events, "path" is the old path and "dest" is the new
+one; for other events, "dest" is None.  A "rescan" event means that events
+were lost (because the operating system's event queue overflowed), and the
+caller should rescan the directory given by "path" to find out what changed.'''
+
+
+class DirectoryWatcher():
+    '''Reports changes to files in a directory tree as they happen.
+
+    This uses the Linux inotify facility, and is only available on Linux.
+    Create a watcher for 'directory' (and, if 'recursive' is True, all its
+    subdirectories, including ones created later) and then call read(...) to
+    wait for the next batch of FileEvent objects, or iterate over events(...)
+    to get batches continuously.  Events that arrive within 'coalesce'
+    seconds of each other are combined into one batch, and duplicates in a
+    batch are removed (e.g., a file that is written in many pieces produces
+    one "modified" event per batch).  A batch is returned at most 'max_batch'
+    seconds after its first event, even if changes keep arriving, so that a
+    file written continuously does not delay it forever.  A watcher uses no
+    CPU while waiting.
+    Call close() when done, or use the watcher in a "with" statement.
+    '''
+
+    def __init__(self, directory, recursive=True, coalesce=0.05, max_batch=1):
+        if not sys.platform.startswith('linux'):
+            raise NotImplementedError('DirectoryWatcher is only available on Linux')
+        import ctypes
+        self._libc = _libc()
+        self._errno = ctypes.get_errno
+        self.directory = os.path.abspath(directory)
+        self._recursive = recursive
+        self._coalesce = coalesce
+        self._max_batch = max_batch
+        self._watches = {}              # Map of watch descriptor -> path.
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(self._errno(), 'inotify_init1 failed')
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLIN)
+        self._add_tree(self.directory)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        '''Stop watching and release the operating system resources.'''
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+    def events(self, timeout=None):
+        '''Yields successive batches (lists) of FileEvent objects.
+
+        If 'timeout' is not None and no events arrive within 'timeout'
+        seconds, iteration stops.  Iteration also stops if interrupt() is
+        called (see the interrupt module) or the watcher is closed.
+        '''
+        while self._fd >= 0 and not interrupted():
+            # Wake up periodically to check for interrupts.
+            wait_time = 0.5 if timeout is None else min(timeout, 0.5)
+            start = monotonic()
+            batch = []
+            while not batch and self._fd >= 0 and not interrupted():
+                batch = self.read(wait_time)
+                if timeout is not None and monotonic() - start >= timeout:
+                    break
+            if not batch:
+                return
+            yield batch
+
+
+    def read(self, timeout=None):
+        '''Waits up to 'timeout' seconds (forever if None) for changes and
+        returns a list of FileEvent objects, which is empty if nothing
+        happened within 'timeout' seconds.'''
+        raw = b''
+        wait_ms = None if timeout is None else int(timeout * 1000)
+        deadline = None
+        while self._poll.poll(wait_ms):
+            with suppress(BlockingIOError):
+                raw += os.read(self._fd, 65536)
+            if deadline is None:
+                deadline = monotonic() + self._max_batch
+            remaining = deadline - monotonic()
+            if remaining <= 0 or len(raw) >= _WATCH_BATCH_BYTES:
+                # Leave the rest in the kernel's queue for the next batch.
+                break
+            # Keep reading for a short time, to collect bursts of changes.
+            wait_ms = int(min(self._coalesce, remaining) * 1000)
+        return self._batch(raw) if raw else []
+
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), _INOTIFY_MASK)
+        if wd < 0:
+            error = self._errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, 'Reached the limit on the number of inotify'
+                              ' watches (see /proc/sys/fs/inotify/max_user_watches)')
+            if __debug__: log(f'unable to watch {path}: {os.strerror(error)}')
+            return
+        self._watches[wd] = path
+
+
+    def _add_tree(self, path, events=None):
+        '''Watches 'path' and, if recursive, its subdirectories.  If 'events'
+        is a list, "created" events are added to it for existing contents,
+        since they may have been created before the watch was in place.'''
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+            self._add_watch(directory)
+            if not self._recursive and directory != path:
+                continue
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        if events is not None:
+                            events.append(FileEvent('created', entry.path, is_dir, None))
+                        if is_dir and self._recursive:
+                            pending.append(entry.path)
+            except OSError:
+                continue
+
+
+    def _forget_tree(self, path):
+        prefix = path + os.sep
+        for wd, watched in list(self._watches.items()):
+            if watched == path or watched.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+
+
+    def _rename_tree(self, old, new):
+        prefix = old + os.sep
+        for wd, watched in self._watches.items():
+            if watched == old:
+                self._watches[wd] = new
+            elif watched.startswith(prefix):
+                self._watches[wd] = new + watched[len(old):]
+
+
+    def _batch(self, raw):
+        events = []
+        moved_from = {}
+        offset = 0
+        while offset + 16 <= len(raw):
+            wd, mask, cookie, length = struct.unpack_from('iIII', raw, offset)
+            name = os.fsdecode(raw[offset + 16:offset + 16 + length].rstrip(b'\0'))
+            offset += 16 + length
+            is_dir = bool(mask & 0x40000000)                # IN_ISDIR
+            if mask & 0x4000:                               # IN_Q_OVERFLOW
+                if __debug__: log('inotify queue overflowed; rescanning')
+                for old_wd in list(self._watches):
+                    self._libc.inotify_rm_watch(self._fd, old_wd)
+                self._watches.clear()
+                self._add_tree(self.directory)
+                events.append(FileEvent('rescan', self.directory, True, None))
+                continue
+            if mask & 0x8000:                               # IN_IGNORED
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            path = join(directory, name) if name else directory
+            if mask & 0x400:                                # IN_DELETE_SELF
+                if path == self.directory:
+                    events.append(FileEvent('deleted', path, True, None))
+            elif mask & 0x100:                              # IN_CREATE
+                events.append(FileEvent('created', path, is_dir, None))
+                if is_dir and self._recursive:
+                    self._add_tree(path, events)
+            elif mask & 0x200:                              # IN_DELETE
+                events.append(FileEvent('deleted', path, is_dir, None))
+            elif mask & 0x40:                               # IN_MOVED_FROM
+                moved_from[cookie] = (path, is_dir)
+            elif mask & 0x80:                               # IN_MOVED_TO
+                if cookie in moved_from:
+                    old, _ = moved_from.pop(cookie)
+                    events.append(FileEvent('moved', old, is_dir, path))
+                    if is_dir:
+                        self._rename_tree(old, path)
+                else:
+                    events.append(FileEvent('created', path, is_dir, None))
+                    if is_dir and self._recursive:
+                        self._add_tree(path, events)
+            elif mask & 0x0a and not is_dir:                # IN_MODIFY, IN_CLOSE_WRITE
+                events.append(FileEvent('modified', path, False, None))
+        # Things moved out of the tree look like deletions from here.
+        for path, is_dir in moved_from.values():
+            events.append(FileEvent('deleted', path, is_dir, None))
+            if is_dir:
+                self._forget_tree(path)
+        return _coalesced(events)
+
+
+# Atomic writes.
+# .............................................................................
+
+class AtomicWriter():
+    '''Writes files atomically, optionally committing them in groups.
+
+    Each file is written to a temporary file in the same directory, which
+    is then renamed over the destination, so that readers (and the file
+    system after a crash) see either the old contents or the new contents
+    but never a partial file.  The value of 'durability' determines how
+    the data is made to survive a system crash or power failure:
+
+      'file': every write calls fsync() on the file and on its directory
+        before returning.  Safe, but slow when writing many small files.
+
+      'batch': writes are held as temporary files until commit() is called
+        (or the "with" block using the writer ends, or 'max_pending' files
+        are waiting).  A commit calls fsync() on all the files, using a
+        pool of 'workers' threads, then renames them all into place, and
+        then calls fsync() once for each distinct parent directory.  If any
+        file cannot be flushed, none are renamed.  Until the commit, the
+        destination files keep their old contents.
+
+      'none': files are renamed into place immediately and nothing is
+        flushed, so writes are atomic with respect to other processes but
+        recently-written files may be lost in a system crash.
+
+    If the "with" block exits because of an exception, pending writes are
+    discarded.  An existing destination file keeps its permission bits.
+    '''
+
+    def __init__(self, durability='batch', max_pending=10000, workers=8):
+        if durability not in ('none', 'batch', 'file'):
+            raise ValueError(f'Unknown durability level: {durability}')
+        self.durability = durability
+        self.max_pending = max_pending
+        self.workers = workers
+        self._pending = []              # List of (temp file, destination).
+        self._lock = threading.Lock()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+    def write(self, file, data, encoding='utf-8'):
+        '''Writes 'data' (bytes, or a str encoded using 'encoding') to 'file'.'''
+        if isinstance(data, str):
+            data = data.encode(encoding)
+        with self.opened(file) as f:
+            f.write(data)
+
+
+    @contextmanager
+    def opened(self, file, mode='wb', encoding=None):
+        '''Context manager returning a file object open for writing 'file'.
+
+        The file is committed according to the writer's durability level
+        when the "with" block ends; if the block raises an exception, the
+        destination is left untouched.
+        '''
+        if mode not in ('w', 'wb', 'wt'):
+            raise ValueError(f'Unsupported mode for atomic writes: {mode}')
+        file = os.fspath(file)
+        directory, name = os.path.split(os.path.abspath(file))
+        tmp = join(directory, f'.{name}.{uuid.uuid4().hex[:12]}.tmp')
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with open(fd, mode, encoding=encoding) as f:
+                yield f
+                f.flush()
+                if self.durability == 'file':
+                    os.fsync(f.fileno())
+            with suppress(FileNotFoundError):
+                os.chmod(tmp, stat.S_IMODE(os.stat(file).st_mode))
+        except BaseException:
+            _removed_quietly(tmp)
+            raise
+        if self.durability == 'batch':
+            with self._lock:
+                self._pending.append((tmp, file))
+                full = len(self._pending) >= self.max_pending
+            if full:
+                self.commit()
+        else:
+            os.replace(tmp, file)
+            if self.durability == 'file':
+                _fsync_directory(directory)
+
+
+    def commit(self):
+        '''Makes all pending writes durable and renames them into place.'''
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        if __debug__: log(f'committing {len(pending)} atomic writes')
+        temp_files = [tmp for tmp, _ in pending]
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for _ in executor.map(_fsync_file, temp_files):
+                    pass
+        except BaseException:
+            # Don't put files in place whose data may not be on disk.
+            for tmp in temp_files:
+                _removed_quietly(tmp)
+            raise
+        directories = {dirname(tmp) for tmp in temp_files}
+        for tmp, file in pending:
+            os.replace(tmp, file)
+        for directory in directories:
+            _fsync_directory(directory)
+
+
+    def discard(self):
+        '''Deletes the temporary files of all pending writes.'''
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for tmp, _ in pending:
+            _removed_quietly(tmp)
+
+
+def atomic_write(file, data, durability='file', encoding='utf-8'):
+    '''Writes 'data' (bytes or str) to 'file' atomically.
+
+    This is a shortcut for writing a single file with AtomicWriter; see
+    that class for the meaning of 'durability'.  To write many files, use
+    an AtomicWriter with durability 'batch' to avoid an fsync() per file.
+    '''
+    with AtomicWriter(durability) as writer:
+        writer.write(file, data, encoding)
+
+
+# Memory-mapped reading.
+# .............................................................................
+
+class MappedFile():
+    '''Read-only access to the contents of a file without copying them.
+
+    The file is memory-mapped, so that view(), chunks(), lines() and
+    records() return memoryview objects that refer directly to the pages of
+    the file in the operating system's cache, instead of copying the data
+    into Python bytes objects.  Files that cannot be mapped (e.g., empty
+    files, pipes, and files in /proc) are read using buffered reads instead;
+    the methods then return memoryviews of bytes objects holding the data,
+    so that callers get the same types either way.  Use bytes(view) to get
+    a copy of a piece of the data that outlives the MappedFile.
+
+    Memoryviews obtained from a MappedFile should be released (or deleted)
+    before calling close(); if any are still alive, the mapping is left for
+    the garbage collector to reclaim.
+    '''
+
+    def __init__(self, file):
+        self.path = os.fspath(file)
+        self._file = open(self.path, 'rb')   # noqa SIM115
+        self._map = None
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError) as ex:
+            if __debug__: log(f'reading {self.path} without mmap: {ex}')
+        except BaseException:
+            self._file.close()
+            raise
+        else:
+            if hasattr(self._map, 'madvise'):
+                self._map.madvise(mmap.MADV_SEQUENTIAL)
+        self._data = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def __len__(self):
+        return len(self._map) if self._map is not None else len(self._contents())
+
+
+    @property
+    def mapped(self):
+        '''True if the file is memory-mapped, False if it is read normally.'''
+        return self._map is not None
+
+
+    def close(self):
+        '''Unmaps and closes the file.'''
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                if __debug__: log(f'views of {self.path} still exist; not unmapping')
+            self._map = None
+        self._data = None
+        self._file.close()
+
+
+    def view(self, start=0, end=None):
+        '''Returns a memoryview of the bytes of the file from 'start' to 'end'.
+
+        If the file is not memory-mapped, this reads the whole file into
+        memory the first time it is called.
+        '''
+        if self._map is not None:
+            return memoryview(self._map)[start:end]
+        return memoryview(self._contents())[start:end]
+
+
+    def chunks(self, size=_COPY_BLOCK_SIZE):
+        '''Yields successive memoryviews of up to 'size' bytes of the file.'''
+        if self._map is not None:
+            whole = memoryview(self._map)
+            for start in range(0, len(whole), size):
+                yield whole[start:start + size]
+        elif self._data is not None:
+            whole = memoryview(self._data)
+            for start in range(0, len(whole), size):
+                yield whole[start:start + size]
+        else:
+            self._rewind()
+            while True:
+                data = self._file.read(size)
+                if not data:
+                    return
+                yield memoryview(data)
+
+
+    def lines(self, keepends=True):
+        '''Yields a memoryview for each line of the file.'''
+        return self.records(separator=b'\n', keepends=keepends)
+
+
+    def records(self, size=None, separator=None, keepends=True):
+        '''Yields memoryviews of the records in the file.
+
+        Records are either 'size' bytes long (the last may be shorter) or
+        end with the bytes 'separator' (the last may lack it).  Unless
+        'keepends' is False, the separator is included in each record.
+        '''
+        if (size is None) == (separator is None):
+            raise ValueError('Exactly one of size and separator must be given')
+        if size is not None:
+            yield from self.chunks(size)
+            return
+        if self._map is None and self._data is None:
+            yield from self._buffered_records(separator, keepends)
+            return
+        source = self._map if self._map is not None else self._data
+        whole = memoryview(source)
+        find = source.find
+        seplen = len(separator)
+        start = 0
+        end = len(source)
+        while start < end:
+            found = find(separator, start)
+            if found < 0:
+                yield whole[start:]
+                return
+            yield whole[start:found + seplen if keepends else found]
+            start = found + seplen
+
+
+    def _buffered_records(self, separator, keepends):
+        seplen = len(separator)
+        pending = b''
+        self._rewind()
+        while True:
+            data = self._file.read(_COPY_BLOCK_SIZE)
+            if not data:
+                if pending:
+                    yield memoryview(pending)
+                return
+            buffer = pending + data if pending else data
+            start = 0
+            # Start the search early enough to find separators split across reads.
+            found = buffer.find(separator, max(0, len(pending) - seplen + 1))
+            while found >= 0:
+                yield memoryview(buffer)[start:found + seplen if keepends else found]
+                start = found + seplen
+                found = buffer.find(separator, start)
+            pending = buffer[start:]
+
+
+    def _contents(self):
+        if self._data is None:
+            self._rewind()
+            self._data = self._file.read()
+        return self._data
+
+
+    def _rewind(self):
+        with suppress(OSError):         # Pipes can only be read once.
+            self._file.seek(0)
+
+
+# Archives.
+# .............................................................................
+
+def write_archive(directory, output, archive_format='tar', compression=None,
+                  extensions=None, recursive=True, ordered=False, workers=4):
+    '''Writes the readable files in 'directory' to a tar or zip archive.
+
+    The value of 'output' can be the path of the archive file to create, or
+    a binary file object such as an open file or sys.stdout.buffer (it need
+    not be seekable).  If 'output' is a path inside 'directory', the archive
+    does not include itself.  The value of 'archive_format' can be "tar" or
+    "zip", and the value of 'compression' can be None, "gz", "bz2" or "xz"
+    (for zip archives, "gz" means deflate and "xz" means lzma).  Files are
+    selected as for iter_files(...) using 'extensions' and 'recursive', and
+    are named in the archive by their paths relative to 'directory'.
+
+    Files are added as they are found, without making copies: a pool of
+    'workers' threads reads small files ahead of time while the archive is
+    compressed and written, and larger files are streamed from disk.  Memory
+    use is bounded regardless of the size of the tree.  If 'ordered' is
+    True, files are added in sorted order, so that the same tree always
+    produces the same sequence of entries.  Stops early if interrupt() is
+    called (see the interrupt module).  Returns the number of files added.
+    '''
+    if archive_format not in ('tar', 'zip'):
+        raise ValueError(f'Unknown archive format: {archive_format}')
+    if compression not in (None, 'gz', 'bz2', 'xz'):
+        raise ValueError(f'Unknown compression: {compression}')
+    files = iter_files(directory, extensions, recursive, sort=ordered)
+    if isinstance(output, (str, os.PathLike)):
+        # Leave out the archive itself, in case it's being written in 'directory'.
+        archive_path = realpath(output)
+        files = (f for f in files if realpath(f) != archive_path)
+        with open(output, 'wb') as f:
+            return _archived(files, directory, f, archive_format, compression, workers)
+    return _archived(files, directory, output, archive_format, compression, workers)
+
+
+def archive_chunks(directory, archive_format='tar', compression=None, extensions=None,
+                   recursive=True, ordered=False, workers=4,
+                   chunk_size=_COPY_BLOCK_SIZE // 8):
+    '''Yields the bytes of an archive of 'directory' in pieces.
+
+    This takes the same arguments as write_archive(...), but instead of
+    writing the archive, it returns a generator of bytes objects of about
+    'chunk_size' bytes each.  The archive is built in a separate thread as
+    the chunks are consumed, so the generator can be passed directly as the
+    "content" of a request made with net(...) to upload the archive while
+    it is being created.  (Since the generator can only be consumed once,
+    such requests cannot be retried.)
+    '''
+    chunks = queue.Queue(maxsize=4)
+    writer = _QueueWriter(chunks, chunk_size)
+    failure = []
+
+    def build():
+        try:
+            write_archive(directory, writer, archive_format, compression,
+                          extensions, recursive, ordered, workers)
+            writer.flush()
+        except _Cancelled:
+            return
+        except Exception as ex:             # noqa PIE786
+            failure.append(ex)
+        with suppress(_Cancelled):
+            writer.put(None)
+
+    thread = threading.Thread(target=build, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        writer.cancelled = True
+        thread.join()
+    if failure:
+        raise failure[0]
+
+
+# Helper functions.
+# .............................................................................
+
+def _file_filter(extensions=None, patterns=None):
+    '''Returns a function that tests whether a file name should be included.'''
+    if isinstance(extensions, FileMatcher):
+        if not patterns:
+            return extensions
+        pattern_matcher = FileMatcher(patterns=patterns)
+        return lambda name: extensions(name) and pattern_matcher(name)
+    return FileMatcher(extensions, patterns)
+
+
+@lru_cache(maxsize=64)
+def _substrings_regex(substrings):
+    '''Returns a compiled regex that finds any of the given substrings.'''
+    return re.compile('|'.join(re.escape(substring) for substring in substrings))
+
+
+def _scanned(directory, wanted):
+    '''Returns a tuple of lists (files, subdirectories) in 'directory'.
+
+    Only readable files whose names pass the test function 'wanted' are
+    included.  This uses os.scandir(), so that the file type information
+    returned by the operating system can be used without calling stat().
+    '''
+    files = []
+    subdirs = []
+    try:
+        if __debug__: log(f'reading directory {directory}')
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        if wanted(entry.name) and readable(entry.path):
+                            files.append(entry.path)
+                    elif entry.is_dir():
+                        subdirs.append(entry.path)
+                except OSError:
+                    continue
+    except OSError as ex:
+        if __debug__: log(f'unable to read directory {directory}: {ex}')
+    return files, subdirs
+
+
+def _copied_data(infd, outfd):
+    '''Copies the contents of file descriptor 'infd' to 'outfd', trying the
+    fastest methods first, and returns the name of the method used.'''
+    size = os.fstat(infd).st_size
+    if size == 0:
+        # Files in /proc and similar places report a size of 0 but have
+        # content.  Reading until the end is the only reliable approach.
+        _copy_segment_userspace(infd, outfd, 0, None)
+        return 'copy'
+    try:
+        import fcntl
+        fcntl.ioctl(outfd, _FICLONE, infd)
+        return 'reflink'
+    except (ImportError, OSError) as ex:
+        if isinstance(ex, OSError) and ex.errno not in _FALLBACK_ERRNOS:
+            raise
+    segments = list(_data_segments(infd, size))
+    candidates = [('copy_file_range', _copy_segment_range),
+                  ('sendfile', _copy_segment_sendfile),
+                  ('copy', _copy_segment_userspace)]
+    for name, copier in candidates:
+        if name == 'copy_file_range' and not hasattr(os, 'copy_file_range'):
+            continue
+        try:
+            complete = all(copier(infd, outfd, start, end) == end
+                           for start, end in segments)
+        except OSError as ex:
+            if ex.errno not in _FALLBACK_ERRNOS or name == 'copy':
+                raise
+            if __debug__: log(f'{name} failed ({ex}); trying next method')
+            os.ftruncate(outfd, 0)
+            continue
+        if not complete:
+            # The file has less data than its size says (e.g., files in /sys
+            # report a size of 4096), or it shrank while being copied.
+            if __debug__: log(f'{name} ended early; copying until end of file')
+            os.ftruncate(outfd, 0)
+            _copy_segment_userspace(infd, outfd, 0, None)
+            return 'copy'
+        # Set the size explicitly, in case the file ends with a hole.
+        os.ftruncate(outfd, size)
+        return name
+
+
+def _data_segments(fd, size):
+    '''Yields (start, end) offsets of the regions of 'fd' containing data.'''
+    if not hasattr(os, 'SEEK_DATA'):
+        yield (0, size)
+        return
+    position = 0
+    while position < size:
+        try:
+            start = os.lseek(fd, position, os.SEEK_DATA)
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+        except OSError as ex:
+            if ex.errno == errno.ENXIO:
+                # No more data after 'position'.
+                return
+            # The file system doesn't support finding holes.
+            yield (position, size)
+            return
+        yield (start, min(end, size))
+        position = end
+
+
+# The _copy_segment_* functions return the offset reached, which is less than
+# 'end' if the end of the input file was reached first.
+
+def _copy_segment_range(infd, outfd, start, end):
+    position = start
+    while position < end:
+        count = os.copy_file_range(infd, outfd, min(end - position, _COPY_BLOCK_SIZE),
+                                   position, position)
+        if count == 0:
+            break
+        position += count
+    return position
+
+
+def _copy_segment_sendfile(infd, outfd, start, end):
+    os.lseek(outfd, start, os.SEEK_SET)
+    position = start
+    while position < end:
+        count = os.sendfile(outfd, infd, position, min(end - position, _COPY_BLOCK_SIZE))
+        if count == 0:
+            break
+        position += count
+    return position
+
+
+def _copy_segment_userspace(infd, outfd, start, end):
+    # If 'end' is None, this copies until the end of the file.
+    os.lseek(infd, start, os.SEEK_SET)
+    os.lseek(outfd, start, os.SEEK_SET)
+    position = start
+    while end is None or position < end:
+        limit = _COPY_BLOCK_SIZE if end is None else min(end - position, _COPY_BLOCK_SIZE)
+        data = os.read(infd, limit)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            written = os.write(outfd, view)
+            view = view[written:]
+        position += len(data)
+    return position
+
+
+def _tree_contents(directory):
+    '''Returns lists of the relative paths of the subdirectories, regular
+    files, and symbolic links in the tree rooted at 'directory'.
+
+    Symbolic links are listed as entries in their own right: the walk never
+    follows them, even if they point to directories.
+    '''
+    dirs = []
+    files = []
+    links = []
+    pending = [directory]
+    while pending:
+        path = pending.pop()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    rel = relpath(entry.path, directory)
+                    try:
+                        if entry.is_symlink():
+                            links.append(rel)
+                        elif entry.is_dir(follow_symlinks=False):
+                            dirs.append(rel)
+                            pending.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            files.append(rel)
+                    except OSError:
+                        continue
+        except OSError as ex:
+            if __debug__: log(f'unable to read directory {path}: {ex}')
+    return dirs, files, links
+
+
+def _deleted_in_background(trash, workers):
+    '''Starts deleting 'trash' in a background thread and returns a Future.'''
+    with _trash_lock:
+        _trash_in_progress.add(trash)
+    future = Future()
+    future.set_running_or_notify_cancel()
+
+    def delete():
+        try:
+            _removed_tree(trash, workers)
+            purge_trash(dirname(trash), workers)
+        except BaseException as ex:     # noqa PIE786
+            if __debug__: log(f'background deletion of {trash} failed: {ex}')
+            future.set_exception(ex)
+        else:
+            if __debug__: log(f'finished background deletion of {trash}')
+            future.set_result(None)
+        finally:
+            with _trash_lock:
+                _trash_in_progress.discard(trash)
+
+    threading.Thread(target=delete, daemon=True).start()
+    return future
+
+
+def _trash_owner_alive(path):
+    '''Returns True if the trash directory 'path' was created by another
+    process that is still running (and may still be deleting it).'''
+    pid = os.path.basename(path)[len(_TRASH_PREFIX):].partition('-')[0]
+    if not pid.isdigit() or int(pid) == os.getpid() or os.name != 'posix':
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # E.g., PermissionError: the process exists but belongs to someone else.
+        return True
+    return True
+
+
+def _removed_tree(path, workers):
+    '''Deletes the directory tree 'path' using a pool of 'workers' threads.
+
+    The tree is processed one level at a time: the directories of a level are
+    read in parallel, their files are unlinked in parallel batches, and the
+    subdirectories found make up the next level.  The emptied directories are
+    then removed, deepest level first.  This way, a tree with a single large
+    subdirectory is deleted as quickly as a wide one.
+    '''
+    if os.path.islink(path) or not isdir(path):
+        raise NotADirectoryError(f'Not a directory: {path}')
+
+    def contents(directory):
+        files, subdirs = [], []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    files.append(entry.path)
+        return files, subdirs
+
+    def unlinked(files):
+        for file in files:
+            os.unlink(file)
+
+    levels = []
+    level = [path]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while level:
+            levels.append(level)
+            files, level = [], []
+            for found, subdirs in executor.map(contents, levels[-1]):
+                files.extend(found)
+                level.extend(subdirs)
+            batches = (files[i:i + _DELETE_BATCH] for i in range(0, len(files), _DELETE_BATCH))
+            for _ in executor.map(unlinked, batches):
+                pass
+        for level in reversed(levels):
+            for _ in executor.map(os.rmdir, level):
+                pass
+
+
+class _MetadataCache():
+    '''Cache of the results of file system calls; see metadata_cache().'''
+
+    def __init__(self, ttl=None):
+        self._ttl = ttl
+        self._values = {}
+        self._lock = threading.Lock()
+
+
+    def value(self, key, compute):
+        now = monotonic() if self._ttl is not None else 0
+        with self._lock:
+            entry = self._values.get(key)
+        if entry and (self._ttl is None or now - entry[0] < self._ttl):
+            return entry[1]
+        # Compute outside the lock, so that slow system calls don't serialize.
+        value = compute()
+        with self._lock:
+            self._values[key] = (now, value)
+        return value
+
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+def _current_cache():
+    '''Returns the metadata cache in effect in this thread, or None.'''
+    return getattr(_metadata_local, 'cache', None)
+
+
+def _cached(key, compute):
+    '''Returns compute(), using the metadata cache if one is in effect.'''
+    cache = _current_cache()
+    return cache.value(key, compute) if cache else compute()
+
+
+def _scanned_with_cache(cache, directory, wanted):
+    '''Calls _scanned(...) in a worker thread with the caller's 'cache'.'''
+    previous = _current_cache()
+    _metadata_local.cache = cache
+    try:
+        return _scanned(directory, wanted)
+    finally:
+        _metadata_local.cache = previous
+
+
+def _stat(path):
+    '''Returns os.stat(path), or None if it fails, using the metadata cache.'''
+    def stat_or_none():
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+    return _cached(('stat', path), stat_or_none)
+
+
+def _batch(function, paths):
+    '''Returns [function(path) for path in paths] using a metadata cache.'''
+    if _current_cache():
+        return [function(path) for path in paths]
+    with metadata_cache():
+        return [function(path) for path in paths]
+
+
+def _coalesced(events):
+    '''Returns the list of FileEvent objects without redundant events.'''
+    created = {e.path for e in events if e.kind == 'created'}
+    seen = set()
+    result = []
+    for event in events:
+        if event in seen or (event.kind == 'modified' and event.path in created):
+            continue
+        seen.add(event)
+        result.append(event)
+    return result
+
+
+@lru_cache(maxsize=None)
+def _libc():
+    '''Returns a ctypes handle on the C library.'''
+    import ctypes
+    import ctypes.util
+    return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+
+def _fsync_file(path):
+    '''Flushes the data of the file 'path' to disk.'''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_directory(directory):
+    '''Flushes the directory entries of 'directory', where possible.'''
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return                          # E.g., on Windows.
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass                            # Some file systems don't support it.
+    finally:
+        os.close(fd)
+
+
+def _removed_quietly(path):
+    with suppress(OSError):
+        os.remove(path)
+
+
+def _url_like(file):
+    '''Returns True if 'file' is a URL according to validator_collection.'''
+    # is_url() only accepts strings containing one of these protocol prefixes,
+    # so check for them first: validator_collection takes a long time to load
+    # and is_url() is slow.  This also delays loading validator_collection
+    # until it's needed, so that application startup times can be faster.
+    if not isinstance(file, str) or '://' not in file:
+        return False
+    lowercase = file.lower()
+    if not any(p in lowercase for p in ('http://', 'https://', 'ftp://')):
+        return False
+    from validator_collection.checkers import is_url
+    return is_url(file)
+
+
+def _relpath_or_none(path, start):
+    try:
+        return relpath(path, start)
+    except (ValueError, OSError):
+        return None
+
+
+_ZIP_COMPRESSION = {None: zipfile.ZIP_STORED, 'gz': zipfile.ZIP_DEFLATED,
+                    'bz2': zipfile.ZIP_BZIP2, 'xz': zipfile.ZIP_LZMA}
+
+
+def _prefetched(files, workers):
+    '''Yields (path, stat result, data) for 'files', in order, reading
+    small files in a pool of threads; 'data' is None for large files.'''
+    def read(path):
+        try:
+            st = os.stat(path)
+            if st.st_size > _PREFETCH_LIMIT:
+                return path, st, None
+            with open(path, 'rb') as f:
+                return path, st, f.read()
+        except OSError as ex:
+            if __debug__: log(f'skipping {path}: {ex}')
+            return None
+
+    window = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for path in files:
+                window.append(executor.submit(read, path))
+                if len(window) >= workers * 4:
+                    result = window.pop(0).result()
+                    if result:
+                        yield result
+            for future in window:
+                result = future.result()
+                if result:
+                    yield result
+        finally:
+            for future in window:
+                future.cancel()
+
+
+def _archived(files, directory, output, archive_format, compression, workers):
+    '''Writes the 'files' of 'directory' to an archive in the binary file
+    object 'output' and returns the number of files written.'''
+    count = 0
+    if archive_format == 'tar':
+        archive = tarfile.open(fileobj=output, mode='w|' + (compression or ''))
+    else:
+        archive = zipfile.ZipFile(output, 'w', _ZIP_COMPRESSION[compression])
+    with archive:
+        for path, st, data in _prefetched(files, workers):
+            if interrupted():
+                if __debug__: log('interrupted -- stopping archive')
+                break
+            arcname = relpath(path, directory).replace(os.sep, '/')
+            if archive_format == 'tar':
+                _added_to_tar(archive, path, arcname, st, data)
+            else:
+                _added_to_zip(archive, path, arcname, st, data)
+            count += 1
+    if __debug__: log(f'wrote {count} files from {directory} to {archive_format} archive')
+    return count
+
+
+def _added_to_tar(archive, path, arcname, st, data):
+    info = tarfile.TarInfo(arcname)
+    info.mtime = st.st_mtime
+    info.mode = stat.S_IMODE(st.st_mode)
+    if data is not None:
+        info.size = len(data)
+        archive.addfile(info, io.BytesIO(data))
+    else:
+        info.size = st.st_size
+        with open(path, 'rb') as f:
+            archive.addfile(info, f)
+
+
+def _added_to_zip(archive, path, arcname, st, data):
+    date_time = max(localtime(st.st_mtime)[:6], (1980, 1, 1, 0, 0, 0))
+    info = zipfile.ZipInfo(arcname, date_time)
+    info.external_attr = (st.st_mode & 0xFFFF) << 16
+    info.compress_type = archive.compression
+    if data is not None:
+        archive.writestr(info, data)
+    else:
+        info.file_size = st.st_size
+        zip64 = st.st_size > zipfile.ZIP64_LIMIT
+        with open(path, 'rb') as src, archive.open(info, 'w', force_zip64=zip64) as dst:
+            shutil.copyfileobj(src, dst, _COPY_BLOCK_SIZE)
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _QueueWriter():
+    '''Minimal write-only file object that puts its data on a queue.'''
+
+    def __init__(self, chunks, chunk_size):
+        self._chunks = chunks
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self.cancelled = False
+
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self._chunk_size:
+            self.flush()
+        return len(data)
+
+
+    def flush(self):
+        if self._buffer:
+            self.put(bytes(self._buffer))
+            self._buffer.clear()
+
+
+    def put(self, item):
+        while not self.cancelled:
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _Cancelled()
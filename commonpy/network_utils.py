@@ -14,9 +14,16 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
+from   collections import deque, namedtuple
+from   concurrent.futures import ThreadPoolExecutor
+from   contextlib import contextmanager, suppress
 from   ipaddress import ip_address
-from   os import stat
+from   os import remove, stat
+import queue
 import socket
+import sqlite3
+import threading
+from   time import monotonic, time
 import urllib.parse
 
 if __debug__:
@@ -25,7 +32,7 @@ if __debug__:
 from .interrupt import wait, interrupted, raise_for_interrupts
 from .exceptions import ArgumentError, Interrupted, InternalError, NoContent
 from .exceptions import AuthenticationFailure, ServiceFailure, NetworkFailure
-from .exceptions import RateLimitExceeded
+from .exceptions import RateLimitExceeded, ResponseTooLarge, TransferStalled
 from .string_utils import antiformat
 
 
@@ -43,6 +50,13 @@ maximum wait time that will be reached after repeated retries.'''
 _KNOWN_HTTP_METHODS = ['get', 'post', 'head', 'options', 'put', 'delete', 'patch']
 '''Known http methods.'''
 
+_UPLOAD_CHUNK_SIZE = 1024 * 1024
+'''Number of bytes read from a file at a time when uploading it.'''
+
+_MIN_RATE_WINDOW = 5
+'''Number of seconds over which the transfer rate is measured when checking
+transfers against a minimum rate (the "min_rate" argument of some functions).'''
+
 
 # Main functions.
 # .............................................................................
@@ -116,7 +130,8 @@ def on_localhost(url):
     return False
 
 
-def timed_request(method, url, client=None, **kwargs):
+def timed_request(method, url, client=None, max_bytes=None, min_rate=None,
+                  **kwargs):
     '''Perform a network access, automatically retrying if exceptions occur.
 
     The value given to parameter "method" must be a string chosen from among
@@ -133,17 +148,29 @@ def timed_request(method, url, client=None, **kwargs):
     codes, specifically 400, 409, 502, 503, and 504.  These are sometimes the
     result of temporary server problems or other issues and disappear when a
     second attempt is made after a brief pause.
+
+    If "max_bytes" is not None, the response body is read in streaming mode
+    and the exception ResponseTooLarge is raised as soon as it is known to
+    be larger than "max_bytes" (either from the Content-Length header or
+    while reading).  If "min_rate" is not None, TransferStalled is raised if
+    the body is received at fewer than "min_rate" bytes per second, measured
+    over intervals of a few seconds.  These errors are not retried.
     '''
     import httpx
 
     def addurl(text):
         return f'{text} for {url}'
 
+    limited = max_bytes is not None or min_rate is not None
+    if limited and client == 'stream':
+        raise ArgumentError('Size and rate limits cannot be used with streams')
     if client is None:
         timeout = httpx.Timeout(15, connect=15, read=15, write=15)
         client = httpx.Client(timeout=timeout, http2=True, verify=False)
     elif client == 'stream':
         client = httpx.stream
+    if limited:
+        send_kwargs = {k: kwargs.pop(k) for k in ['auth', 'follow_redirects'] if k in kwargs}
 
     response = None
     failures = 0
@@ -151,8 +178,14 @@ def timed_request(method, url, client=None, **kwargs):
     while failures <= _MAX_CONSECUTIVE_FAILS and not interrupted():
         try:
             if __debug__: log(addurl(f'doing http {method}'))
-            func = getattr(client, method)
-            response = func(url, **kwargs)
+            if limited:
+                request = client.build_request(method.upper(), url, **kwargs)
+                response = client.send(request, stream=True, **send_kwargs)
+                chunks = _checked_chunks(response, url, max_bytes, min_rate)
+                response = _buffered_response(response, b''.join(chunks))
+            else:
+                func = getattr(client, method)
+                response = func(url, **kwargs)
             # For some statuses, retry once, in case it's a transient problem.
             code = response.status_code
             if __debug__: log(addurl(f'got response with code {code}'))
@@ -165,6 +198,10 @@ def timed_request(method, url, client=None, **kwargs):
             # This can happen if the installation environment has inconsistecies.
             log('import error: ' + str(ex))
             raise
+        except (ResponseTooLarge, TransferStalled) as ex:
+            # Retrying would just do the same thing again.
+            if __debug__: log(addurl(f'transfer aborted: {antiformat(ex)}'))
+            raise
         except (TypeError, httpx.UnsupportedProtocol) as ex:
             # Bad arguments to the call, like passing data to a 'get'.
             if __debug__: log(addurl(f'exception {antiformat(ex)}'))
@@ -217,7 +254,7 @@ def timed_request(method, url, client=None, **kwargs):
 
 
 def net(method, url, client=None, handle_rate=True,
-        polling=False, recursing=0, **kwargs):
+        polling=False, recursing=0, max_bytes=None, min_rate=None, **kwargs):
     '''Invoke HTTP "method" on 'url' with optional keyword arguments provided.
 
     Returns a tuple of (response, exception), where the first element is
@@ -241,6 +278,12 @@ def net(method, url, client=None, handle_rate=True,
     the URL.  It is up to the caller to implement the polling schedule and
     call this function (with polling = True) as needed.
 
+    If keyword 'max_bytes' is not None, responses larger than that number of
+    bytes are abandoned as soon as the size is known, and the exception
+    ResponseTooLarge is returned.  If keyword 'min_rate' is not None, a
+    transfer that slows to less than that many bytes per second is abandoned
+    and the exception TransferStalled is returned.
+
     This method always passes the argument follow_redirects = True to the
     underlying Python HTTPX library network calls.
     '''
@@ -257,7 +300,8 @@ def net(method, url, client=None, handle_rate=True,
 
     resp = None
     try:
-        resp = timed_request(method, url, client, follow_redirects=True, **kwargs)
+        resp = timed_request(method, url, client, max_bytes, min_rate,
+                             follow_redirects=True, **kwargs)
     except (httpx.NetworkError, httpx.ProtocolError) as ex:
         # timed_request() will have retried, so if we get here, time to bail.
         if __debug__: log(info(f'network exception: {antiformat(ex)}'))
@@ -299,7 +343,8 @@ def net(method, url, client=None, handle_rate=True,
             if __debug__: log(info('rate limit hit -- pausing', text))
             wait(pause)                   # 5 s, then 10 s, then 15 s, etc.
             if __debug__: log(info(f'doing recursive call #{recursing + 1}', text))
-            return net(method, url, client, handle_rate, polling, recursing + 1, **kwargs)
+            return net(method, url, client, handle_rate, polling, recursing + 1,
+                       max_bytes, min_rate, **kwargs)
         error = RateLimitExceeded(info('Server blocking requests due to rate limits', text))
     elif code in [500, 501, 502, 503, 504, 506, 507, 508]:
         error = ServiceFailure(info(f'Server error (code {code} -- {reason})', text))
@@ -313,7 +358,7 @@ def net(method, url, client=None, handle_rate=True,
 
 
 def network(method, url, client=None, handle_rate=True,
-            polling=False, recursing=0, **kwargs):
+            polling=False, recursing=0, max_bytes=None, min_rate=None, **kwargs):
     '''Invoke HTTP "method" on 'url' with optional keyword arguments provided.
 
     This is an alternative to net(). The difference is that this function only
@@ -321,13 +366,126 @@ def network(method, url, client=None, handle_rate=True,
     it raises an exception. (Compare this to net(...), which returns 2 values.)
     '''
     response, error = net(method, url, client, handle_rate,
-                          polling, recursing, **kwargs)
+                          polling, recursing, max_bytes, min_rate, **kwargs)
     if error:
         raise error
     return response
 
 
-def download_file(url, local_destination):
+def next_link(response):
+    '''Return the URL of the "next" page named in the response's Link header.
+
+    This looks for a header of the form Link: <url>; rel="next" (as described
+    in RFC 8288), and returns the URL resolved against the URL of the
+    response.  If there is no such link, this returns None.  This is the
+    default method used by paginated(...) to find the next page of results.
+    '''
+    link = response.links.get('next', {}).get('url')
+    return urllib.parse.urljoin(str(response.url), link) if link else None
+
+
+def cursor_link(field, param='cursor'):
+    '''Return a function that finds the next page using a cursor value.
+
+    Many APIs put a cursor or continuation token in the JSON body of each
+    page of results, and expect it to be sent back as a query parameter to
+    get the next page.  This returns a function suitable for use as the
+    'next_page' argument to paginated(...).  The function looks up the value
+    of 'field' in the JSON body of a response (a dotted name such as
+    "meta.next" is followed into nested objects) and returns the URL of the
+    request that produced the response, with the query parameter 'param' set
+    to the value found.  If the field is missing or empty, it returns None.
+    '''
+    def extractor(response):
+        value = response.json()
+        for part in field.split('.'):
+            if not isinstance(value, dict):
+                return None
+            value = value.get(part)
+        if value is None or value == '':
+            return None
+        parts = urllib.parse.urlsplit(str(response.request.url))
+        query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        query = [(k, v) for k, v in query if k != param] + [(param, str(value))]
+        return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+    return extractor
+
+
+def paginated(method, url, client=None, next_page=next_link, lookahead=2,
+              handle_rate=True, **kwargs):
+    '''Yield successive pages of results from a paginated network API.
+
+    This generator invokes HTTP "method" on 'url' and yields the response,
+    then uses the function 'next_page' to find the URL of the next page and
+    repeats, until 'next_page' returns None.  The function 'next_page' is
+    given a response object and must return a URL or None; the default is
+    next_link(...), which follows "Link: <url>; rel=next" headers, and
+    cursor_link(...) can be used to create functions for APIs that return
+    cursors in the body of the response.
+
+    Pages are fetched in a background thread while the caller consumes the
+    current one, so that network latency overlaps with the caller's work.
+    Parameter 'lookahead' sets how many pages may be fetched ahead of the
+    caller; the background thread pauses when that many are waiting.
+
+    The network calls are made using network(...), and so have the same
+    retry behavior and raise the same exceptions; an exception raised while
+    fetching a page is raised by this generator when the caller reaches that
+    page.  Parameters 'client' and 'handle_rate' and any additional keyword
+    arguments are passed to network(...), except that keyword 'params' is
+    only used for the first request (subsequent page URLs are assumed to
+    contain all the query parameters needed).
+    '''
+    if lookahead < 1:
+        raise ValueError('Value of lookahead must be at least 1.')
+
+    # Each page fetched takes a slot, which is freed when the caller takes
+    # the page, so at most 'lookahead' pages are fetched ahead of the caller.
+    pages = queue.Queue()
+    slots = threading.Semaphore(lookahead)
+    stop = threading.Event()
+
+    def reserve():
+        # Don't block forever if the caller has stopped consuming pages.
+        while not stop.is_set():
+            if slots.acquire(timeout=0.1):
+                return True
+        return False
+
+    def fetch_pages():
+        page_url = url
+        page_kwargs = kwargs
+        try:
+            while page_url and reserve():
+                raise_for_interrupts()
+                if __debug__: log(f'fetching page {page_url}')
+                response = network(method, page_url, client, handle_rate,
+                                   **page_kwargs)
+                page_url = next_page(response)
+                page_kwargs = {k: v for k, v in kwargs.items() if k != 'params'}
+                pages.put((response, None))
+            pages.put((None, None))
+        except BaseException as ex:     # noqa PIE786
+            if __debug__: log(f'pagination stopped by {antiformat(ex)}')
+            pages.put((None, ex))
+
+    fetcher = threading.Thread(target=fetch_pages, daemon=True)
+    fetcher.start()
+    try:
+        while True:
+            response, error = pages.get()
+            slots.release()
+            if error:
+                raise error
+            if response is None:
+                return
+            yield response
+    finally:
+        stop.set()
+
+
+def download_file(url, local_destination, max_bytes=None, min_rate=None):
     '''Returns True if the content at 'url' could be downloaded to the file
     'local_destination', and False otherwise. It does not throw an exception.'''
 
@@ -335,7 +493,7 @@ def download_file(url, local_destination):
         return f'{text} for {url}'
 
     try:
-        download(url, local_destination)
+        download(url, local_destination, max_bytes=max_bytes, min_rate=min_rate)
     except Exception as ex:             # noqa PIE786
         if __debug__: log(f'download exception: {antiformat(ex)}')
         return False
@@ -343,8 +501,15 @@ def download_file(url, local_destination):
         return True
 
 
-def download(url, local_destination, recursing=0):
-    '''Download the 'url' to the file 'local_destination'.'''
+def download(url, local_destination, recursing=0, max_bytes=None, min_rate=None):
+    '''Download the 'url' to the file 'local_destination'.
+
+    If 'max_bytes' is not None, the download is stopped and ResponseTooLarge
+    is raised as soon as the content is known to be larger than 'max_bytes'.
+    If 'min_rate' is not None, the download is stopped and TransferStalled is
+    raised if the content arrives at fewer than 'min_rate' bytes per second.
+    In both cases, the partially-written file is deleted.
+    '''
     import httpx
 
     def addurl(text):
@@ -361,14 +526,18 @@ def download(url, local_destination, recursing=0):
             recursing += 1
             if recursing <= _MAX_RECURSIVE_CALLS:
                 if __debug__: log('calling download(url) recursively for code 202')
-                download(url, local_destination, recursing)
+                download(url, local_destination, recursing, max_bytes, min_rate)
             else:
                 raise ServiceFailure(addurl('Exceeded max retries for code 202'))
         elif 200 <= code < 400:
-            with open(local_destination, 'wb') as f:
-                for chunk in resp.iter_bytes():
-                    raise_for_interrupts()
-                    f.write(chunk)
+            try:
+                with open(local_destination, 'wb') as f:
+                    for chunk in _checked_chunks(resp, url, max_bytes, min_rate):
+                        f.write(chunk)
+            except (ResponseTooLarge, TransferStalled):
+                if __debug__: log(f'deleting partial download {local_destination}')
+                remove(local_destination)
+                raise
             resp.close()
             size = stat(local_destination).st_size
             if __debug__: log(f'wrote {size} bytes to file {local_destination}')
@@ -388,3 +557,614 @@ def download(url, local_destination, recursing=0):
             raise ServiceFailure(addurl(f'Internal server error (HTTP code {code})'))
         else:
             raise NetworkFailure(f'Unable to resolve {url}')
+
+
+# Uploads.
+# .............................................................................
+
+UploadPart = namedtuple('UploadPart', 'number offset size attempts elapsed response')
+UploadPart.__doc__ = '''Description of one part of a file sent by upload().
+
+The field "attempts" is the number of times the part's content was sent (it
+is greater than 1 if the request was retried), "elapsed" is the time in
+seconds taken by the part, and "response" is the HTTPX response object.'''
+
+
+class UploadResult(namedtuple('UploadResult', 'size elapsed parts')):
+    '''Summary of an upload: total bytes, time in seconds, and list of parts.'''
+
+    @property
+    def throughput(self):
+        '''Average number of bytes per second sent during the upload.'''
+        return self.size / self.elapsed if self.elapsed > 0 else 0
+
+
+class _FileRange():
+    '''Request body that reads a range of bytes from a file in chunks.
+
+    Unlike a generator, this can be iterated more than once, which lets the
+    request be retried; the number of iterations is counted in "attempts".
+    '''
+
+    def __init__(self, path, offset, size, chunk_size):
+        self.path = path
+        self.offset = offset
+        self.size = size
+        self.chunk_size = chunk_size
+        self.attempts = 0
+
+
+    def __iter__(self):
+        self.attempts += 1
+        remaining = self.size
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            while remaining > 0:
+                raise_for_interrupts()
+                chunk = f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+def upload(url, local_source, method='put', client=None, part_size=None,
+           part_url=None, workers=4, chunked=False,
+           chunk_size=_UPLOAD_CHUNK_SIZE, **kwargs):
+    '''Upload the file 'local_source' to 'url' and return an UploadResult.
+
+    The file is streamed from disk 'chunk_size' bytes at a time and is never
+    read into memory all at once.  By default, the content is sent in a single
+    HTTP "method" request with a Content-Length header; if 'chunked' is True,
+    the Content-Length header is omitted and the content is sent using
+    chunked transfer encoding instead.
+
+    If 'part_size' is given, the file is divided into parts of that many
+    bytes and the parts are sent in parallel using up to 'workers' threads.
+    If 'part_url' is None, every part is sent to 'url' with a Content-Range
+    header describing its position in the file.  Otherwise, 'part_url' must
+    be a function that takes a part number (starting at 1) and returns the
+    URL to which that part should be sent, as is done by services that
+    support multipart uploads.
+
+    Requests are made using network(...), which retries in case of transient
+    errors; the UploadPart records in the result report the number of times
+    each part was sent and the time it took.  Parameter 'client' and other
+    keyword arguments are passed to network(...).  If any part fails, the
+    remaining parts are cancelled and the exception is raised.
+    '''
+    size = stat(local_source).st_size
+    headers = dict(kwargs.pop('headers', None) or {})
+
+    def send(number, offset, length):
+        body = _FileRange(local_source, offset, length, chunk_size)
+        part_headers = dict(headers)
+        if not chunked:
+            part_headers['Content-Length'] = str(length)
+        if part_size and not part_url and length > 0:
+            part_headers['Content-Range'] = f'bytes {offset}-{offset + length - 1}/{size}'
+        target = part_url(number) if part_url else url
+        if __debug__: log(f'uploading {length} bytes at offset {offset} to {target}')
+        start = monotonic()
+        response = network(method, target, client, content=body,
+                           headers=part_headers, **kwargs)
+        return UploadPart(number, offset, length, body.attempts,
+                          monotonic() - start, response)
+
+    start = monotonic()
+    if not part_size:
+        parts = [send(1, 0, size)]
+    else:
+        count = max(1, -(-size // part_size))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(send, n + 1, n * part_size,
+                                       min(part_size, size - n * part_size))
+                       for n in range(count)]
+            try:
+                parts = [future.result() for future in futures]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    result = UploadResult(size, monotonic() - start, parts)
+    if __debug__: log(f'uploaded {size} bytes from {local_source} in {len(parts)}'
+                      f' part(s) at {result.throughput:.0f} bytes/s')
+    return result
+
+
+# Helper functions.
+# .............................................................................
+
+def _checked_chunks(response, url, max_bytes=None, min_rate=None):
+    '''Yield the content of the streaming 'response', enforcing limits.
+
+    If 'max_bytes' is not None, this checks the Content-Length header before
+    reading anything and then counts the bytes received, and raises
+    ResponseTooLarge as soon as the limit is exceeded.  If 'min_rate' is not
+    None, this measures the rate at which bytes arrive over intervals of
+    _MIN_RATE_WINDOW seconds, and raises TransferStalled if the rate drops
+    below 'min_rate' bytes/second.  (A connection that delivers no data at
+    all is ended by the read timeout of the network client.)  The response is
+    closed if either exception is raised.
+    '''
+    length = response.headers.get('content-length', '')
+    if max_bytes is not None and length.isdigit() and int(length) > max_bytes:
+        response.close()
+        raise ResponseTooLarge(f'Content-Length of {length} bytes exceeds'
+                               f' the limit of {max_bytes} for {url}')
+    received = 0
+    window_start = monotonic()
+    window_bytes = 0
+    for chunk in response.iter_bytes():
+        raise_for_interrupts()
+        received += len(chunk)
+        if max_bytes is not None and received > max_bytes:
+            response.close()
+            raise ResponseTooLarge(f'Response exceeded the limit of {max_bytes}'
+                                   f' bytes for {url}')
+        if min_rate:
+            window_bytes += len(chunk)
+            elapsed = monotonic() - window_start
+            if elapsed >= _MIN_RATE_WINDOW:
+                if window_bytes / elapsed < min_rate:
+                    response.close()
+                    raise TransferStalled(f'Transfer rate fell below {min_rate}'
+                                          f' bytes/s for {url}')
+                window_start = monotonic()
+                window_bytes = 0
+        yield chunk
+
+
+def _buffered_response(response, content):
+    '''Return a copy of the streamed 'response' holding the bytes 'content'.
+
+    The content has already been decoded by iter_bytes(), so the headers
+    describing the encoded body are left out of the copy; HTTPX then sets
+    Content-Length to match 'content'.
+    '''
+    import httpx
+    response.close()
+    headers = [(k, v) for k, v in response.headers.multi_items()
+               if k.lower() not in ('content-encoding', 'content-length',
+                                    'transfer-encoding')]
+    buffered = httpx.Response(response.status_code, headers=headers,
+                              content=content, request=response.request,
+                              extensions=response.extensions,
+                              history=response.history)
+    # Some transports (e.g., httpx.MockTransport) don't record the time.
+    with suppress(RuntimeError):
+        buffered.elapsed = response.elapsed
+    return buffered
+
+
+# Adaptive concurrency control.
+# .............................................................................
+
+LimitAdjustment = namedtuple('LimitAdjustment',
+                             'host old_limit new_limit reason latency error')
+LimitAdjustment.__doc__ = '''Record of a change made by an AdaptiveLimiter.
+
+The field "reason" is one of "healthy" (for increases), or "rate-limited",
+"unavailable", or "timeout" (for decreases).  The field "latency" is the time
+in seconds taken by the request that triggered the change, and "error" is the
+exception (if any) that was returned for the request.'''
+
+
+class _HostState():
+    '''Internal record of the concurrency state for one host.'''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.min_latency = None
+        self.last_decrease = 0
+
+
+class AdaptiveLimiter():
+    '''Per-host limit on concurrent network requests, adjusted using AIMD.
+
+    An AdaptiveLimiter is meant to be shared by threads that make many
+    network requests.  Each thread calls acquire(url) before a request and
+    release(...) afterwards (or uses the context manager slot(url), or the
+    convenience methods net(...) and network(...), which do both).  Requests
+    to a given host are only allowed to proceed while the number of requests
+    in flight to that host is below the current limit for that host.
+
+    Limits are adjusted using additive increase, multiplicative decrease
+    (AIMD).  Each successful request whose latency is no more than
+    'latency_factor' times the lowest latency seen for the host raises the
+    limit by 'increase' / limit, so that the limit grows by about 'increase'
+    for every full window of healthy requests.  A response with HTTP code 429
+    or 503, or a timeout, multiplies the limit by 'decrease'.  Requests that
+    were started before the most recent decrease do not cause additional
+    decreases, so a burst of failures from one congestion event only reduces
+    the limit once.  Limits stay between 'minimum' and 'maximum'.
+
+    The current limit for a host is available from limit(url), and each
+    change to a limit is recorded as a LimitAdjustment object in the list
+    returned by adjustments() (the most recent 'history' changes are kept).
+    '''
+
+    def __init__(self, initial=4, minimum=1, maximum=64, increase=1,
+                 decrease=0.5, latency_factor=2, history=1000):
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError('Limits must satisfy 1 <= minimum <= initial <= maximum.')
+        if not 0 < decrease < 1:
+            raise ValueError('Value of decrease must be between 0 and 1.')
+        self._initial = initial
+        self._minimum = minimum
+        self._maximum = maximum
+        self._increase = increase
+        self._decrease = decrease
+        self._latency_factor = latency_factor
+        self._hosts = {}
+        self._history = deque(maxlen=history)
+        self._condition = threading.Condition()
+
+
+    def _state(self, url):
+        host = hostname(url) or url
+        if host not in self._hosts:
+            self._hosts[host] = _HostState(self._initial)
+        return host, self._hosts[host]
+
+
+    def limit(self, url):
+        '''Return the current concurrency limit for the host of 'url'.'''
+        with self._condition:
+            return self._state(url)[1].limit
+
+
+    def in_flight(self, url):
+        '''Return the number of requests in progress to the host of 'url'.'''
+        with self._condition:
+            return self._state(url)[1].in_flight
+
+
+    def adjustments(self):
+        '''Return a list of recent LimitAdjustment records, oldest first.'''
+        with self._condition:
+            return list(self._history)
+
+
+    def acquire(self, url):
+        '''Wait until a request to 'url' is allowed, and return a token.
+
+        The token must be passed to release(...) after the request finishes.
+        '''
+        with self._condition:
+            host, state = self._state(url)
+            while state.in_flight >= max(1, int(state.limit)):
+                raise_for_interrupts()
+                self._condition.wait(0.1)
+            state.in_flight += 1
+            return (host, monotonic())
+
+
+    def release(self, token, response=None, error=None):
+        '''Record the outcome of a request and adjust the limit for its host.
+
+        Parameter 'token' must be the value returned by acquire(...).  The
+        values of 'response' and 'error' should be those returned by net(...).
+        '''
+        import httpx
+
+        host, started = token
+        latency = monotonic() - started
+        code = response.status_code if response is not None else None
+        if code == 429 or isinstance(error, RateLimitExceeded):
+            reason = 'rate-limited'
+        elif code == 503:
+            reason = 'unavailable'
+        elif isinstance(error, httpx.TimeoutException):
+            reason = 'timeout'
+        else:
+            reason = None
+        with self._condition:
+            state = self._hosts[host]
+            state.in_flight -= 1
+            old_limit = state.limit
+            if reason:
+                if started >= state.last_decrease:
+                    state.limit = max(self._minimum, state.limit * self._decrease)
+                    state.last_decrease = monotonic()
+            elif error is None:
+                if state.min_latency is None or latency < state.min_latency:
+                    state.min_latency = latency
+                if latency <= state.min_latency * self._latency_factor:
+                    state.limit = min(self._maximum,
+                                      state.limit + self._increase / state.limit)
+                    reason = 'healthy'
+            if int(state.limit) != int(old_limit):
+                if __debug__: log(f'{host} concurrency limit {old_limit:.2f}'
+                                  f' -> {state.limit:.2f} ({reason})')
+                self._history.append(LimitAdjustment(host, old_limit, state.limit,
+                                                     reason, latency, error))
+            self._condition.notify_all()
+
+
+    @contextmanager
+    def slot(self, url):
+        '''Context manager that holds a request slot for 'url'.
+
+        The value of the context is a function that must be called with the
+        (response, error) values of the request, so that the limiter can
+        adjust the limit.  If the body of the "with" statement raises an
+        exception without having called the function, the exception is
+        recorded as the error.
+        '''
+        token = self.acquire(url)
+        outcome = []
+        try:
+            yield lambda response, error=None: outcome.append((response, error))
+        except Exception as ex:         # noqa PIE786
+            outcome.append((None, ex))
+            raise
+        finally:
+            self.release(token, *(outcome[0] if outcome else (None, None)))
+
+
+    def net(self, method, url, client=None, polling=False, **kwargs):
+        '''Call net(...) on 'url' while holding a request slot for its host.
+
+        This returns the same (response, error) values as net(...).  Rate
+        limit responses are not retried automatically (i.e., net(...) is called
+        with handle_rate = False), so that the limiter can react to them; the
+        caller receives RateLimitExceeded and can decide when to try again.
+        '''
+        with self.slot(url) as record:
+            response, error = net(method, url, client, handle_rate=False,
+                                  polling=polling, **kwargs)
+            record(response, error)
+        return (response, error)
+
+
+    def network(self, method, url, client=None, polling=False, **kwargs):
+        '''Like net(...) but returns only the response and raises errors.'''
+        response, error = self.net(method, url, client, polling, **kwargs)
+        if error:
+            raise error
+        return response
+
+
+# Persistent download queue.
+# .............................................................................
+
+DownloadTask = namedtuple('DownloadTask', 'id url destination attempts')
+DownloadTask.__doc__ = '''A download claimed from a DownloadQueue.'''
+
+
+class DownloadQueue():
+    '''Persistent queue of downloads, kept in an SQLite database file.
+
+    Each entry in the queue is a URL and a local destination file.  Entries
+    are in one of the states "pending", "in-progress", "done", or "failed",
+    and the queue records the number of attempts made for each entry and the
+    result (the file size, or the error message for failures).  Because the
+    state is kept on disk, a program that is stopped by a crash or interrupt
+    can reopen the queue and continue where it left off: when the queue is
+    opened, entries left "in-progress" are returned to "pending" (unless
+    'recover' is False).  A queue file should only be used by one process at
+    a time, but any number of threads in that process can use it.
+
+    The simplest way to process the queue is to call run(...), which drains
+    it using a pool of threads that call download(...).  Alternatively,
+    callers can use claim(...) to get DownloadTask objects and report the
+    outcome of each using done(...), failed(...), or release(...).  Call
+    close() when done, or use the queue in a "with" statement.
+    '''
+
+    PENDING = 'pending'
+    IN_PROGRESS = 'in-progress'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path, recover=True):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []          # All connections, for close().
+        self._lock = threading.Lock()
+        db = self._db()
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('''CREATE TABLE IF NOT EXISTS downloads (
+                        id INTEGER PRIMARY KEY,
+                        url TEXT NOT NULL,
+                        destination TEXT NOT NULL,
+                        state TEXT NOT NULL DEFAULT 'pending',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        result TEXT,
+                        updated REAL)''')
+        db.execute('CREATE INDEX IF NOT EXISTS downloads_state ON downloads (state, id)')
+        if recover:
+            self.recover()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        '''Close the database connections of all threads.'''
+        with self._lock:
+            for db in self._connections:
+                db.close()
+            self._connections.clear()
+
+
+    def _db(self):
+        # SQLite connections can't be shared between threads, so each thread
+        # gets its own connection.  Transactions are managed explicitly.  The
+        # connections are only used by their own threads, but close() may be
+        # called from any thread, hence check_same_thread = False.
+        if not getattr(self._local, 'db', None):
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute('PRAGMA synchronous = NORMAL')
+            with self._lock:
+                self._connections.append(db)
+            self._local.db = db
+        return self._local.db
+
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        else:
+            db.execute('COMMIT')
+
+
+    def add(self, url, destination):
+        '''Add a download to the queue and return its id.'''
+        with self._transaction() as db:
+            cursor = db.execute('INSERT INTO downloads (url, destination, updated)'
+                                ' VALUES (?, ?, ?)', (url, destination, time()))
+            return cursor.lastrowid
+
+
+    def add_many(self, downloads):
+        '''Add an iterable of (url, destination) pairs in one transaction.'''
+        now = time()
+        with self._transaction() as db:
+            cursor = db.executemany('INSERT INTO downloads (url, destination, updated)'
+                                    ' VALUES (?, ?, ?)',
+                                    ((url, dest, now) for url, dest in downloads))
+            return cursor.rowcount
+
+
+    def claim(self, count=1):
+        '''Mark up to 'count' pending downloads as in progress and return them.
+
+        The return value is a list of DownloadTask objects, in the order in
+        which they were added to the queue.  The list is empty if there are no
+        pending downloads.  The attempt count of each task is incremented.
+        '''
+        with self._transaction() as db:
+            rows = db.execute('SELECT id, url, destination, attempts FROM downloads'
+                              ' WHERE state = ? ORDER BY id LIMIT ?',
+                              (self.PENDING, count)).fetchall()
+            db.executemany('UPDATE downloads SET state = ?, attempts = attempts + 1,'
+                           ' updated = ? WHERE id = ?',
+                           ((self.IN_PROGRESS, time(), row[0]) for row in rows))
+        return [DownloadTask(id_, url, dest, attempts + 1)
+                for id_, url, dest, attempts in rows]
+
+
+    def _finish(self, task, state, result=None, attempts_change=0):
+        with self._transaction() as db:
+            db.execute('UPDATE downloads SET state = ?, result = ?, updated = ?,'
+                       ' attempts = attempts + ? WHERE id = ?',
+                       (state, None if result is None else str(result), time(),
+                        attempts_change, task.id))
+
+
+    def done(self, task, result=None):
+        '''Mark the DownloadTask 'task' as done, with an optional result.'''
+        self._finish(task, self.DONE, result)
+
+
+    def failed(self, task, error, max_attempts=1):
+        '''Record that the DownloadTask 'task' failed with the given 'error'.
+
+        If the task has been attempted fewer than 'max_attempts' times, it is
+        returned to the pending state so that it will be tried again.
+        '''
+        retry = task.attempts < max_attempts
+        self._finish(task, self.PENDING if retry else self.FAILED, error)
+
+
+    def release(self, task):
+        '''Return the DownloadTask 'task' to the queue without counting it as
+        an attempt.  This is meant for tasks that were claimed but not done.'''
+        self._finish(task, self.PENDING, attempts_change=-1)
+
+
+    def recover(self):
+        '''Return downloads left in progress to the pending state.
+
+        This is done automatically when the queue is opened (unless the queue
+        was created with recover = False).  Returns the number of downloads
+        affected.
+        '''
+        with self._transaction() as db:
+            cursor = db.execute('UPDATE downloads SET state = ?, updated = ?'
+                                ' WHERE state = ?',
+                                (self.PENDING, time(), self.IN_PROGRESS))
+        if __debug__ and cursor.rowcount:
+            log(f'returned {cursor.rowcount} unfinished downloads to the queue')
+        return cursor.rowcount
+
+
+    def counts(self):
+        '''Return a dict with the number of downloads in each state.'''
+        counts = dict.fromkeys([self.PENDING, self.IN_PROGRESS, self.DONE, self.FAILED], 0)
+        rows = self._db().execute('SELECT state, count(*) FROM downloads GROUP BY state')
+        counts.update(rows.fetchall())
+        return counts
+
+
+    def entries(self, state=None):
+        '''Yield (url, destination, state, attempts, result) tuples for the
+        downloads in the queue, optionally only those in the given 'state'.'''
+        query = 'SELECT url, destination, state, attempts, result FROM downloads'
+        if state:
+            yield from self._db().execute(query + ' WHERE state = ? ORDER BY id', (state,))
+        else:
+            yield from self._db().execute(query + ' ORDER BY id')
+
+
+    def run(self, workers=4, max_attempts=3, batch_size=10, downloader=None):
+        '''Process the pending downloads using a pool of 'workers' threads.
+
+        Each download is performed by calling downloader(url, destination),
+        which defaults to download(...).  Downloads that raise an exception
+        are retried until they have been attempted 'max_attempts' times, after
+        which they are marked as failed.  Workers claim 'batch_size' downloads
+        at a time.  If interrupt() is called, the workers stop and return the
+        downloads they have not finished to the queue, and this method raises
+        the interrupt exception (see raise_for_interrupts()).  Otherwise, it
+        returns the result of counts() when the queue has been drained.
+        '''
+        downloader = downloader or download
+
+        def worker():
+            while not interrupted():
+                tasks = self.claim(batch_size)
+                if not tasks:
+                    return
+                for index, task in enumerate(tasks):
+                    if interrupted():
+                        for unfinished in tasks[index:]:
+                            self.release(unfinished)
+                        return
+                    try:
+                        downloader(task.url, task.destination)
+                    except BaseException as ex:     # noqa PIE786
+                        if interrupted():
+                            for unfinished in tasks[index:]:
+                                self.release(unfinished)
+                            return
+                        if __debug__: log(f'download of {task.url} failed: {antiformat(ex)}')
+                        self.failed(task, str(ex), max_attempts)
+                    else:
+                        try:
+                            self.done(task, stat(task.destination).st_size)
+                        except OSError:
+                            self.done(task)
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        raise_for_interrupts()
+        return self.counts()
@@ -67,3 +67,53 @@ def test_json_dumps_dict():
     s = json.dumps(CaseFoldDict({'A': 1, 'B': 2}))
     assert 'A' in s
     assert 'B' in s
+
+
+def test_sequence_view():
+    data = list(range(10))
+    view = SequenceView(data, 2, 8)
+    assert len(view) == 6
+    assert view[0] == 2 and view[-1] == 7
+    assert view == [2, 3, 4, 5, 6, 7]
+    assert view[::2] == (2, 4, 6)
+    assert isinstance(view[1:3], SequenceView)
+    assert 5 in view and 9 not in view
+    assert list(reversed(view[:2])) == [3, 2]
+    data[2] = 'x'
+    assert view[0] == 'x'
+    with pytest.raises(IndexError):
+        view[6]
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, 0.01, items=range(1000))
+    assert all(i in bloom for i in range(1000))
+    false_positives = sum(i in bloom for i in range(1000, 11000))
+    assert false_positives < 300
+    assert bloom.add('new') is False
+    assert bloom.add('new') is True
+
+
+def test_range_set():
+    ranges = RangeSet('20-30, 1-5,9,4-7,31')
+    assert ranges.intervals == [(1, 7), (9, 9), (20, 31)]
+    assert str(ranges) == '1-7,9,20-31'
+    assert len(ranges) == 20
+    assert 9 in ranges and '25' in ranges
+    assert 8 not in ranges and 32 not in ranges and 0 not in ranges and 'x' not in ranges
+    assert list(RangeSet('3-1,7')) == [1, 2, 3, 7]
+    assert RangeSet([5, (1, 3), 4]) == RangeSet('1-5')
+    assert not RangeSet() and RangeSet('') == RangeSet()
+    huge = RangeSet('1-1000000000000')
+    assert 999999999999 in huge and len(huge) == 1000000000000
+    with pytest.raises(ValueError):
+        RangeSet('1-5,x')
+
+    a = RangeSet('1-10,20-30,40')
+    b = RangeSet('5-22,25,28-45')
+    for x, y in [(a, b), (b, a), (a, RangeSet()), (a, a)]:
+        assert set(x | y) == set(x) | set(y)
+        assert set(x & y) == set(x) & set(y)
+        assert set(x - y) == set(x) - set(y)
+    assert str(a - b) == '1-4,23-24,26-27'
+    assert str(a.union(b)) == '1-45'
@@ -16,12 +16,38 @@ from commonpy.data_utils import *
 def test_sliced():
     assert list(sliced([1, 2, 3, 4], 2)) == [[1, 3], [2, 4]]
     assert list(sliced([1, 2, 3, 4, 5], 2)) == [[1, 3, 5], [2, 4]]
+    assert list(sliced([1, 2, 3, 4, 5], 2, views=True)) == [[1, 3, 5], [2, 4]]
+    assert [list(s) for s in sliced(iter(range(5)), 2)] == [[0, 2, 4], [1, 3]]
+    first, second = sliced((x * 2 for x in range(6)), 2)
+    assert list(zip(first, second)) == [(0, 2), (4, 6), (8, 10)]
+
+
+def test_chunked():
+    data = [1, 2, 3, 4, 5]
+    chunks = list(chunked(data, 2))
+    assert chunks == [[1, 2], [3, 4], [5]]
+    data[0] = 'changed'
+    assert chunks[0][0] == 'changed'         # Views, not copies.
+    assert list(chunked('abcde', 2)) == ['ab', 'cd', 'e']
+    assert list(chunked((x for x in range(5)), 3)) == [[0, 1, 2], [3, 4]]
+    endless = iter(int, 1)
+    assert next(chunked(endless, 4)) == [0, 0, 0, 0]
+
+
+def test_chunked_by_size():
+    items = [b'aaa', b'bb', b'cccc', b'd', 'é', b'x' * 10]
+    assert list(chunked_by_size(items, 5)) == [[b'aaa', b'bb'], [b'cccc', b'd'],
+                                               ['é'], [b'x' * 10]]
+    assert list(chunked_by_size(items, 100, max_items=4)) == [items[:4], items[4:]]
+    assert list(chunked_by_size([[1, 2], [3]], 2, size=len)) == [[[1, 2]], [[3]]]
 
 
 def test_expanded_range():
     assert expanded_range('1-5') == ['1', '2', '3', '4', '5']
     assert expanded_range('2-10') == ['2', '3', '4', '5', '6', '7', '8', '9', '10']
     assert expanded_range('-5') == ['1', '2', '3', '4', '5']
+    assert expanded_range('1-3,7,9-10') == ['1', '2', '3', '7', '9', '10']
+    assert expanded_range('1,3,5') == ['1', '3', '5']
     try:
         # It's a malformed expression.
         assert expanded_range('5-') == '5-'
@@ -383,3 +409,112 @@ def test_timestamp():
 @freeze_time("2012-01-14 03:21:34", tz_offset=-4)
 def test_parsed_datetime():
     assert str(parsed_datetime(timestamp())) == "2012-01-13 15:21:34-08:00"
+
+
+def test_iter_flattened():
+    original = {'a': 1, 'b': {'c': 2, 'd': []}, 'e': [{'f': 3}, 4], 'g': {}}
+    assert list(iter_flattened(original)) == [('a', 1), ('b.c', 2), ('b.d', []),
+                                              ('e.0.f', 3), ('e.1', 4), ('g', None)]
+    assert dict(iter_flattened(original, 'x', '_')) == flattened(original, 'x', '_')
+    assert list(iter_flattened([[1, [2]], 'ab', (3,)])) == [1, 2, 'ab', 3]
+    with pytest.raises(TypeError):
+        iter_flattened(5)
+
+    # Nesting deeper than the recursion limit.
+    deep = value = {}
+    for _ in range(sys.getrecursionlimit() + 100):
+        value['k'] = {}
+        value = value['k']
+    value['v'] = 1
+    (key, leaf), = flattened(deep).items()
+    assert key.endswith('k.v') and leaf == 1
+
+
+def test_columnized():
+    records = [{'a': 1, 'b': {'c': 2.5}, 'e': 'x'},
+               {'a': 2, 'd': [1, 2], 'e': None},
+               {'b': {'c': 1}, 'a': 3, 'e': []}]
+    columns = columnized(iter(records))
+    assert list(columns) == ['a', 'b.c', 'e', 'd.0', 'd.1']
+    assert columns['b.c'] == Column([2.5, None, 1], [False, True, False])
+    assert columns['e'] == Column(['x', None, []], [False, False, False])
+    assert columns['d.1'] == Column([None, 2, None], [True, False, True])
+    assert list(uncolumnized(columns)) == records
+
+    from array import array
+    columns = columnized(records, kind='array')
+    assert columns['a'].values == array('q', [1, 2, 3])
+    assert columns['b.c'] == Column(array('d', [2.5, 0, 1]), array('B', [0, 1, 0]))
+    assert columns['e'].values == ['x', None, []]
+    assert list(uncolumnized(columns)) == records
+
+    with pytest.raises(TypeError):
+        columnized([[1, 2]])
+
+
+def test_columnized_numpy():
+    numpy = pytest.importorskip('numpy')
+    records = [{'a': 1, 'b': True, 'c': [1]}, {'a': 2, 'c': 'x'}]
+    columns = columnized(records, kind='numpy')
+    assert columns['a'].values.dtype == numpy.int64
+    assert list(columns['b'].mask) == [False, True]
+    assert list(uncolumnized(columns)) == records
+
+
+def test_unflattened():
+    original = {'a': 1, 'b': {'c': [{'d': 2}, 3], 'e': []}, 'f': None}
+    assert unflattened(flattened(original)) == original
+    assert unflattened(flattened(original, separator='/'), separator='/') == original
+    assert unflattened({'x.0': 'a', 'x.2': 'b'}) == {'x': {'0': 'a', '2': 'b'}}
+    with pytest.raises(ValueError):
+        unflattened({'a': 1, 'a.b': 2})
+    with pytest.raises(ValueError):
+        unflattened({'a.b': 2, 'a': 1})
+
+
+def test_parallel_map():
+    from commonpy.exceptions import TaskFailure
+    from commonpy.interrupt import interrupt, reset_interrupts
+
+    assert list(parallel_map(lambda x: x * x, range(100), workers=4)) == [x * x for x in range(100)]
+    squares = parallel_map(lambda x: x * x, iter(range(100)), workers=4, ordered=False)
+    assert sorted(squares) == [x * x for x in range(100)]
+    assert list(parallel_map(abs, [-3, 2, -1], workers=2, processes=True)) == [3, 2, 1]
+
+    results = []
+    with pytest.raises(TaskFailure) as info:
+        for value in parallel_map(lambda x: 10 // x, [5, 2, 0, 1], chunk_size=1):
+            results.append(value)
+    assert results == [2, 5]
+    assert info.value.index == 2 and info.value.item == 0
+    assert isinstance(info.value.__cause__, ZeroDivisionError)
+
+    def interrupting(x):
+        if x == 50:
+            interrupt()
+        return x
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            list(parallel_map(interrupting, range(1000), workers=2, chunk_size=10))
+    finally:
+        reset_interrupts()
+
+
+def test_deduplicated():
+    items = deduplicated(iter([3, 1, 3, 2, 1, 4]))
+    assert list(items) == [3, 1, 2, 4]
+    assert items.dropped == 2
+
+    records = [{'a': [1, 2]}, {'a': (1, 2)}, {'a': [1, 2]}, {'b': {1}}, {'b': {1}}]
+    assert list(deduplicated(records)) == [{'a': [1, 2]}, {'a': (1, 2)}, {'b': {1}}]
+    assert list(deduplicated(['a', 'B', 'A', 'b'], key=str.lower)) == ['a', 'B']
+
+    items = deduplicated([1, 2, 1, 3, 4, 1, 2], mode='window', size=2)
+    assert list(items) == [1, 2, 3, 4, 1, 2]
+    assert items.dropped == 1
+
+    items = deduplicated((i % 1000 for i in range(5000)), mode='bloom', size=1000)
+    assert len(list(items)) > 990
+    assert items.dropped >= 4000
+    with pytest.raises(ValueError):
+        deduplicated([], mode='other')
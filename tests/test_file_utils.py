@@ -57,3 +57,536 @@ def test_relative():
     assert relative('http://foo.com/file.jpg') == 'http://foo.com/file.jpg'
     assert relative('file://path/to/file.jpg') == 'file:/path/to/file.jpg'
     assert relative('ftp://foo.com/file.jpg') == 'ftp://foo.com/file.jpg'
+
+
+def test_relative_paths():
+    here = os.path.abspath('.')
+    paths = [os.path.join(here, '..', 'setup.cfg'), os.path.join(here, 'a.txt'),
+             os.path.join(here, 'sub', 'b.txt'), os.path.join(here, 'sub', 'c.txt'),
+             '/', 'x.txt', './y.txt', 'sub/..', 'sub/./z', '../../elsewhere', '',
+             'http://foo.com/file', 'file://path/to/file.jpg', 'path/http://x']
+    assert relative_paths(paths) == [relative(p) for p in paths]
+
+
+def test_iter_files(tmpdir):
+    for path in ['a.txt', 'b.jpg', 'sub/c.txt', 'sub/d.TXT', 'sub/deeper/e.txt']:
+        tmpdir.join(path).write('x', ensure=True)
+    names = lambda paths: sorted(os.path.relpath(p, tmpdir) for p in paths)
+    assert names(iter_files(tmpdir)) == ['a.txt', 'b.jpg', 'sub/c.txt', 'sub/d.TXT', 'sub/deeper/e.txt']
+    assert names(iter_files(tmpdir, extensions=['.txt'])) == ['a.txt', 'sub/c.txt', 'sub/d.TXT', 'sub/deeper/e.txt']
+    assert names(iter_files(tmpdir, patterns=['*.jpg', 'c.*'])) == ['b.jpg', 'sub/c.txt']
+    assert names(iter_files(tmpdir, recursive=False)) == ['a.txt', 'b.jpg']
+    assert names(iter_files(tmpdir, max_depth=1)) == ['a.txt', 'b.jpg', 'sub/c.txt', 'sub/d.TXT']
+    assert list(iter_files(tmpdir, sort=True)) == files_in_directory(tmpdir)
+    assert list(iter_files(tmpdir.join('nonexistent'))) == []
+
+
+def test_iter_files_parallel(tmpdir):
+    for d in range(5):
+        for f in range(5):
+            tmpdir.join(f'dir{d}/sub/file{f}.txt').write('x', ensure=True)
+        tmpdir.join(f'dir{d}/file.jpg').write('x', ensure=True)
+    assert sorted(iter_files_parallel(tmpdir, workers=4)) == files_in_directory(tmpdir)
+    assert (sorted(iter_files_parallel(tmpdir, extensions=['.jpg']))
+            == files_in_directory(tmpdir, extensions=['.jpg']))
+    ordered = list(iter_files_parallel(tmpdir, workers=4, ordered=True))
+    assert ordered == list(iter_files_parallel(tmpdir, workers=2, ordered=True))
+    assert os.path.relpath(ordered[0], tmpdir) == 'dir0/file.jpg'
+    assert os.path.relpath(ordered[1], tmpdir) == 'dir0/sub/file0.txt'
+    assert len(list(iter_files_parallel(tmpdir, max_depth=1))) == 5
+
+
+def test_iter_files_parallel_bounded(tmpdir, monkeypatch):
+    import commonpy.file_utils
+    for d in range(100):
+        tmpdir.join(f'dir{d:03}/file.txt').write('x', ensure=True)
+    scanned = []
+    original = commonpy.file_utils._scanned
+    def counting(directory, wanted):
+        scanned.append(directory)
+        return original(directory, wanted)
+    monkeypatch.setattr(commonpy.file_utils, '_scanned', counting)
+    for ordered in [True, False]:
+        scanned.clear()
+        files = iter_files_parallel(tmpdir, workers=1, ordered=ordered)
+        for _ in range(10):
+            next(files)
+        # Only a few directories beyond those yielded have been read ahead.
+        assert len(scanned) <= 10 + 4 + 1
+        files.close()
+
+
+def test_changed_files(tmpdir):
+    tree = tmpdir.mkdir('tree')
+    for path in ['a.txt', 'b.txt', 'sub/c.txt', 'sub/deeper/d.txt']:
+        tree.join(path).write('x', ensure=True)
+    index = str(tmpdir.join('index.gz'))
+    changes = changed_files(tree, index)
+    assert len(changes.added) == 4
+    assert changed_files(tree, index) == ([], [], [])
+
+    tree.join('sub/deeper/new.txt').write('new')
+    tree.join('b.txt').remove()
+    tree.join('sub/c.txt').write('changed content')
+    changes = changed_files(tree, index)
+    assert changes.added == [str(tree.join('sub/deeper/new.txt'))]
+    assert changes.removed == [str(tree.join('b.txt'))]
+    assert changes.modified == [str(tree.join('sub/c.txt'))]
+
+    snapshot = DirectorySnapshot.load(index)
+    assert snapshot.diff(DirectorySnapshot.scan(tree, snapshot, trust_dir_mtime=True)) == ([], [], [])
+    tree.join('e.txt').write('x')
+    assert changed_files(tree, index, trust_dir_mtime=True).added == [str(tree.join('e.txt'))]
+
+
+def test_file_hashes(tmpdir):
+    import hashlib
+    tree = tmpdir.mkdir('tree')
+    for path, content in [('a.txt', 'one'), ('b.txt', 'two'), ('sub/c.txt', 'one')]:
+        tree.join(path).write(content, ensure=True)
+    a = str(tree.join('a.txt'))
+    assert file_hash(a) == hashlib.sha256(b'one').hexdigest()
+    assert file_hash(a, 'md5') == hashlib.md5(b'one').hexdigest()
+
+    cache = HashCache(str(tmpdir.join('hashes.db')))
+    files = files_in_directory(tree)
+    first = file_hashes(files, cache=cache)
+    assert first[a] == hashlib.sha256(b'one').hexdigest()
+    assert file_hashes(files, cache=cache) == first
+    tree.join('a.txt').write('changed')
+    assert file_hashes([a], cache=cache)[a] == hashlib.sha256(b'changed').hexdigest()
+
+
+def test_manifest_and_duplicates(tmpdir):
+    tree = tmpdir.mkdir('tree')
+    for path, content in [('a.txt', 'one'), ('b.txt', 'two'), ('sub/c.txt', 'one')]:
+        tree.join(path).write(content, ensure=True)
+    manifest = str(tree.join('manifest-sha256.txt'))
+    assert write_manifest(tree, manifest) == 3
+    assert verify_manifest(manifest) == ([], [])
+    tree.join('b.txt').write('tampered')
+    tree.join('sub/c.txt').remove()
+    assert verify_manifest(manifest) == ([str(tree.join('b.txt'))], [str(tree.join('sub', 'c.txt'))])
+    tree.join('sub/c.txt').write('one')
+    assert duplicate_files(files_in_directory(tree)) == [[str(tree.join('a.txt')), str(tree.join('sub/c.txt'))]]
+
+
+def test_copy_file_methods(tmpdir):
+    src = str(tmpdir.join('src.bin'))
+    data = os.urandom(300000)
+    with open(src, 'wb') as f:
+        f.write(data)
+    os.utime(src, (1000000000, 1000000000))
+    dst = str(tmpdir.join('dst.bin'))
+    method = copy_file(src, dst)
+    assert method in ['reflink', 'copy_file_range', 'sendfile', 'copy', 'copy2']
+    with open(dst, 'rb') as f:
+        assert f.read() == data
+    assert os.stat(dst).st_mtime == 1000000000
+
+    subdir = tmpdir.mkdir('subdir')
+    copy_file(src, str(subdir))
+    assert subdir.join('src.bin').read_binary() == data
+    with pytest.raises(Exception):
+        copy_file(src, src)
+    assert tmpdir.join('src.bin').read_binary() == data
+
+
+def test_copy_file_sparse(tmpdir):
+    src = str(tmpdir.join('sparse.bin'))
+    with open(src, 'wb') as f:
+        f.write(b'start')
+        f.seek(50 * 1024 * 1024)
+        f.write(b'middle')
+        f.truncate(100 * 1024 * 1024)
+    dst = str(tmpdir.join('copy.bin'))
+    copy_file(src, dst)
+    assert os.path.getsize(dst) == os.path.getsize(src)
+    with open(dst, 'rb') as f:
+        assert f.read(5) == b'start'
+        f.seek(50 * 1024 * 1024)
+        assert f.read(6) == b'middle'
+    if hasattr(os.stat(dst), 'st_blocks'):
+        assert os.stat(dst).st_blocks <= os.stat(src).st_blocks + 64
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='Linux only')
+def test_copy_file_fallback(tmpdir, monkeypatch):
+    import errno
+    def unsupported(*args):
+        raise OSError(errno.ENOSYS, 'not supported')
+    src = tmpdir.join('src.txt')
+    src.write('some text')
+    monkeypatch.setattr(os, 'copy_file_range', unsupported, raising=False)
+    import fcntl
+    monkeypatch.setattr(fcntl, 'ioctl', unsupported)
+    assert copy_file(str(src), str(tmpdir.join('dst1.txt'))) == 'sendfile'
+    monkeypatch.setattr(os, 'sendfile', unsupported)
+    assert copy_file(str(src), str(tmpdir.join('dst2.txt'))) == 'copy'
+    assert tmpdir.join('dst2.txt').read() == 'some text'
+
+
+def test_copy_file_short_source(tmpdir, monkeypatch):
+    # Files in /sys report a size of 4096 bytes but contain less data.
+    if os.path.exists('/sys/devices/system/cpu/online'):
+        dst = str(tmpdir.join('online'))
+        copy_file('/sys/devices/system/cpu/online', dst)
+        with open('/sys/devices/system/cpu/online', 'rb') as f:
+            assert open(dst, 'rb').read() == f.read()
+    # Simulate kernel copy functions that stop before the reported size.
+    import errno
+    import fcntl
+    def unsupported(*args):
+        raise OSError(errno.ENOSYS, 'not supported')
+    monkeypatch.setattr(fcntl, 'ioctl', unsupported)
+    monkeypatch.setattr(os, 'copy_file_range', lambda *args: 0, raising=False)
+    src = tmpdir.join('src.txt')
+    src.write('some text')
+    dst = tmpdir.join('dst.txt')
+    assert copy_file(str(src), str(dst)) == 'copy'
+    assert dst.read() == 'some text'
+
+
+def test_copy_and_sync_tree(tmpdir):
+    src = tmpdir.mkdir('src')
+    for path in ['a.txt', 'sub/b.txt', 'sub/deeper/c.txt']:
+        src.join(path).write(path, ensure=True)
+    src.mkdir('empty')
+    dst = tmpdir.join('dst')
+    report = copy_tree(str(src), str(dst), workers=2)
+    assert len(report.copied) == 3
+    assert dst.join('sub/deeper/c.txt').read() == 'sub/deeper/c.txt'
+    assert dst.join('empty').isdir()
+    assert report.size == sum(len(p) for p in ['a.txt', 'sub/b.txt', 'sub/deeper/c.txt'])
+
+    report = copy_tree(str(src), str(dst))
+    assert len(report.copied) == 0 and len(report.skipped) == 3
+    src.join('a.txt').write('different length')
+    report = copy_tree(str(src), str(dst), compare='hash')
+    assert [f.src for f in report.copied] == [str(src.join('a.txt'))]
+
+    dst.join('extra/file.txt').write('x', ensure=True)
+    report = sync_tree(str(src), str(dst))
+    assert [f.dst for f in report.files if f.action == 'deleted'] == [str(dst.join('extra/file.txt'))]
+    assert not dst.join('extra').exists()
+
+
+def test_copy_tree_flat_and_conflicts(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('a.txt').write('a')
+    report = copy_tree(str(src), str(tmpdir.join('dst')))
+    assert [f.action for f in report.files] == ['copied']
+    report = sync_tree(str(src), str(tmpdir.join('other')))
+    assert tmpdir.join('other', 'a.txt').read() == 'a'
+
+    # A file where a directory is needed is reported, not fatal.
+    src.join('sub/b.txt').write('b', ensure=True)
+    tmpdir.join('dst', 'sub').write('in the way')
+    report = copy_tree(str(src), str(tmpdir.join('dst')))
+    assert {os.path.basename(f.dst) for f in report.failed} == {'sub', 'b.txt'}
+    assert [f.src for f in report.skipped] == [str(src.join('a.txt'))]
+
+
+def test_sync_tree_symlinks(tmpdir):
+    outside = tmpdir.mkdir('outside')
+    outside.join('precious').write('x')
+    src = tmpdir.mkdir('src')
+    src.join('a.txt').write('a')
+    src.join('loop').mksymlinkto(src)
+    dst = tmpdir.mkdir('dst')
+    dst.join('link').mksymlinkto(outside)
+    report = sync_tree(str(src), str(dst))
+    assert outside.join('precious').exists()
+    assert not dst.join('link').exists()
+    assert dst.join('loop').islink()
+    assert [f.dst for f in report.files if f.action == 'deleted'] == [str(dst.join('link'))]
+
+
+def test_copy_tree_interrupted(tmpdir):
+    from commonpy.interrupt import interrupt, reset_interrupts
+    src = tmpdir.mkdir('src')
+    src.join('a.txt').write('a')
+    interrupt()
+    try:
+        report = copy_tree(str(src), str(tmpdir.join('dst')))
+    finally:
+        reset_interrupts()
+    assert report.interrupted
+    assert report.files == []
+
+
+def test_delete_existing_background(tmpdir):
+    tree = tmpdir.mkdir('tree')
+    for d in range(10):
+        for f in range(10):
+            tree.join(f'dir{d}/sub/file{f}.txt').write('x', ensure=True)
+    tree.join('top.txt').write('x')
+    # A single large subdirectory is deleted in batches.
+    for f in range(600):
+        tree.join(f'only/child/file{f}.txt').write('x', ensure=True)
+    # Simulate leftover trash from a run that crashed.
+    leftover = tmpdir.join('.commonpy-trash-999999999-0')
+    leftover.join('old/file.txt').write('x', ensure=True)
+
+    future = delete_existing(str(tree), background=True)
+    assert not tree.exists()
+    future.result(timeout=30)
+    assert os.listdir(tmpdir) == []
+
+    assert delete_existing(str(tmpdir.join('nothing.txt').ensure())) is None
+
+
+def test_delete_existing_background_symlink(tmpdir):
+    target = tmpdir.mkdir('target')
+    target.join('file.txt').write('x')
+    work = tmpdir.mkdir('work')
+    work.join('link').mksymlinkto(target)
+    result = delete_existing(str(work.join('link')), background=True)
+    assert result is None
+    assert not os.path.lexists(str(work.join('link')))
+    assert target.join('file.txt').exists()
+    # Leftover trash that is a link is removed without following it.
+    work.join('.commonpy-trash-999999999-0').mksymlinkto(target)
+    assert purge_trash(str(work)) == 1
+    assert target.join('file.txt').exists()
+
+
+def test_metadata_cache(tmpdir):
+    path = str(tmpdir.join('later.txt'))
+    with metadata_cache() as cache:
+        assert not readable(path)
+        with open(path, 'w') as f:
+            f.write('x')
+        # The cached answer is reused until the cache is cleared.
+        assert not readable(path)
+        cache.clear()
+        assert readable(path)
+        assert nonempty(path)
+    with metadata_cache(ttl=0):
+        assert readable(path)
+
+
+def test_metadata_cache_threads(tmpdir):
+    import threading
+    path = str(tmpdir.join('later.txt'))
+    inside = threading.Event()
+    done = threading.Event()
+    def other():
+        with metadata_cache():
+            assert not readable(path)
+            inside.set()
+            done.wait(5)
+    thread = threading.Thread(target=other)
+    thread.start()
+    inside.wait(5)
+    # The other thread's cache doesn't apply here.
+    with open(path, 'w') as f:
+        f.write('x')
+    assert readable(path)
+    with metadata_cache():
+        assert readable(path)
+    done.set()
+    thread.join()
+
+
+def test_batch_predicates(tmpdir):
+    full = tmpdir.join('full.txt')
+    full.write('x')
+    empty = tmpdir.join('empty.txt')
+    empty.write('')
+    missing = tmpdir.join('missing.txt')
+    paths = [str(full), str(empty), str(missing)]
+    assert readable_paths(paths) == [True, True, False]
+    assert nonempty_paths(paths) == [True, False, False]
+    assert writable_paths(paths + [str(tmpdir)]) == [True, True, True, True]
+
+
+def test_file_matcher(tmpdir):
+    matcher = FileMatcher(extensions=['.TXT', '.tar.gz'])
+    assert matcher('/some/dir.d/file.txt')
+    assert matcher('archive.TAR.GZ')
+    assert matcher('archive.gz') is False
+    assert matcher('.txt') is False
+    assert list(matcher.matching(['a.txt', 'b.jpg', 'c.tar.gz'])) == ['a.txt', 'c.tar.gz']
+    matcher = FileMatcher(extensions=['.txt'], patterns=['a*', 'b?.txt'])
+    assert list(matcher.matching(['a.txt', 'a.jpg', 'b1.txt', 'b12.txt'])) == ['a.txt', 'b1.txt']
+
+    for path in ['a.txt', 'b.jpg', 'sub/c.txt']:
+        tmpdir.join(path).write('x', ensure=True)
+    assert files_in_directory(tmpdir, FileMatcher(['.txt'])) == files_in_directory(tmpdir, ['.txt'])
+
+
+def test_filtered_by_extensions():
+    items = ['a.txt', 'B.JPG', 'c.tar.gz', 'notes.txt.bak']
+    assert filtered_by_extensions(items, ['.jpg', '.txt']) == ['c.tar.gz']
+    assert filtered_by_extensions(items, ['.gz']) == ['a.txt', 'B.JPG', 'notes.txt.bak']
+    assert filtered_by_extensions(items, []) == items
+    assert filtered_by_extensions(items, FileMatcher(['.txt'])) == ['B.JPG', 'c.tar.gz', 'notes.txt.bak']
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='requires inotify')
+def test_directory_watcher(tmpdir):
+    def changes(watcher):
+        events = []
+        while True:
+            batch = watcher.read(0.5)
+            if not batch:
+                return {(e.kind, os.path.basename(e.path),
+                         e.dest and os.path.basename(e.dest)) for e in events}
+            events += batch
+
+    with DirectoryWatcher(str(tmpdir), coalesce=0.1) as watcher:
+        assert watcher.read(0.05) == []
+        tmpdir.join('a.txt').write('x')
+        tmpdir.join('sub', 'b.txt').write('y', ensure=True)
+        assert changes(watcher) == {('created', 'a.txt', None),
+                                    ('created', 'sub', None),
+                                    ('created', 'b.txt', None)}
+
+        tmpdir.join('a.txt').write('more')
+        os.rename(str(tmpdir.join('sub')), str(tmpdir.join('moved')))
+        assert changes(watcher) == {('modified', 'a.txt', None),
+                                    ('moved', 'sub', 'moved')}
+
+        # The watch on the moved directory must report the new path.
+        tmpdir.join('moved', 'b.txt').remove()
+        tmpdir.join('a.txt').remove()
+        events = []
+        for _ in range(5):
+            events += watcher.read(0.5)
+        assert {(e.kind, e.path) for e in events} == {
+            ('deleted', str(tmpdir.join('moved', 'b.txt'))),
+            ('deleted', str(tmpdir.join('a.txt')))}
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='requires inotify')
+def test_directory_watcher_continuous_writes(tmpdir):
+    import threading
+    from time import sleep
+    stop = threading.Event()
+    def writer():
+        with open(str(tmpdir.join('log.txt')), 'w') as f:
+            while not stop.is_set():
+                f.write('x')
+                f.flush()
+                sleep(0.01)
+    with DirectoryWatcher(str(tmpdir), coalesce=0.1, max_batch=0.3) as watcher:
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            start = time()
+            assert watcher.read(1)
+            assert time() - start < 1
+        finally:
+            stop.set()
+            thread.join()
+
+
+def test_atomic_writer(tmpdir):
+    target = str(tmpdir.join('out.txt'))
+    atomic_write(target, 'first')
+    os.chmod(target, 0o640)
+    with AtomicWriter('batch') as writer:
+        writer.write(target, 'second')
+        for i in range(5):
+            writer.write(str(tmpdir.join(f'{i}.dat')), bytes([i]) * 10)
+        # Nothing is visible until the batch is committed.
+        assert open(target).read() == 'first'
+        assert not os.path.exists(str(tmpdir.join('0.dat')))
+    assert open(target).read() == 'second'
+    assert os.stat(target).st_mode & 0o777 == 0o640
+    assert open(str(tmpdir.join('4.dat')), 'rb').read() == b'\x04' * 10
+
+    with pytest.raises(RuntimeError):
+        with AtomicWriter('batch') as writer:
+            with writer.opened(target, 'w') as f:
+                f.write('third')
+            raise RuntimeError()
+    assert open(target).read() == 'second'
+    assert sorted(os.listdir(str(tmpdir))) == ['0.dat', '1.dat', '2.dat', '3.dat',
+                                               '4.dat', 'out.txt']
+    writer = AtomicWriter('none', max_pending=2)
+    writer.write(target, b'fourth')
+    assert open(target).read() == 'fourth'
+
+
+def test_atomic_writer_fsync_failure(tmpdir, monkeypatch):
+    import commonpy.file_utils
+    target = str(tmpdir.join('out.txt'))
+    atomic_write(target, 'first')
+    def failing(path):
+        raise OSError(5, 'Input/output error')
+    monkeypatch.setattr(commonpy.file_utils, '_fsync_file', failing)
+    with pytest.raises(OSError):
+        with AtomicWriter('batch') as writer:
+            writer.write(target, 'second')
+    assert open(target).read() == 'first'
+    assert os.listdir(str(tmpdir)) == ['out.txt']
+
+
+def test_mapped_file(tmpdir):
+    path = tmpdir.join('data.txt')
+    path.write_binary(b'one\ntwo\n\nthree')
+    with MappedFile(str(path)) as mf:
+        assert mf.mapped
+        assert len(mf) == 14
+        assert bytes(mf.view(4, 7)) == b'two'
+        assert [bytes(l) for l in mf.lines()] == [b'one\n', b'two\n', b'\n', b'three']
+        assert [bytes(l) for l in mf.lines(keepends=False)] == [b'one', b'two', b'', b'three']
+        assert [bytes(c) for c in mf.chunks(5)] == [b'one\nt', b'wo\n\nt', b'hree']
+        assert [bytes(r) for r in mf.records(size=7)] == [b'one\ntwo', b'\n\nthree']
+        assert [bytes(r) for r in mf.records(separator=b'\n\n')] == [b'one\ntwo\n\n', b'three']
+
+    empty = tmpdir.join('empty')
+    empty.write('')
+    with MappedFile(str(empty)) as mf:
+        assert not mf.mapped
+        assert len(mf) == 0
+        assert list(mf.lines()) == []
+
+    # Non-mappable files fall back to buffered reads with the same results.
+    if not os.path.exists('/dev/fd'):
+        return
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'a\r\nbb\r\nc')
+    os.close(write_fd)
+    with MappedFile(f'/dev/fd/{read_fd}') as mf:
+        assert not mf.mapped
+        assert [bytes(r) for r in mf.records(separator=b'\r\n', keepends=False)] == [b'a', b'bb', b'c']
+    os.close(read_fd)
+
+
+def test_write_archive(tmpdir, monkeypatch):
+    import commonpy.file_utils
+    import io
+    import tarfile
+    import zipfile
+    monkeypatch.setattr(commonpy.file_utils, '_PREFETCH_LIMIT', 10)
+    src = tmpdir.join('src')
+    contents = {'a.txt': b'small', 'sub/b.txt': b'larger than the limit' * 100,
+                'sub/deeper/c.jpg': b'c'}
+    for name, data in contents.items():
+        src.join(name).write_binary(data, ensure=True)
+
+    archive = str(tmpdir.join('out.tar.gz'))
+    assert write_archive(str(src), archive, compression='gz', ordered=True) == 3
+    with tarfile.open(archive) as tar:
+        assert tar.getnames() == sorted(contents)
+        assert {name: tar.extractfile(name).read() for name in contents} == contents
+
+    data = b''.join(archive_chunks(str(src), archive_format='zip', compression='xz',
+                                   extensions=['.txt'], chunk_size=64))
+    with zipfile.ZipFile(io.BytesIO(data)) as zip:
+        assert sorted(zip.namelist()) == ['a.txt', 'sub/b.txt']
+        assert zip.read('sub/b.txt') == contents['sub/b.txt']
+
+    # Abandoning the generator early must not leave the builder hanging.
+    chunks = archive_chunks(str(src), chunk_size=16)
+    assert next(chunks)
+    chunks.close()
+
+    # An archive written inside the directory doesn't include itself.
+    inside = str(src.join('inside.tar'))
+    assert write_archive(str(src), inside, ordered=True) == 3
+    with tarfile.open(inside) as tar:
+        assert tar.getnames() == sorted(contents)
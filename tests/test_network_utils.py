@@ -73,3 +73,224 @@ def test_netloc():
     assert netloc('https://foo.com') == 'foo.com'
     assert netloc('aserver.com')     == 'aserver.com'
     assert netloc('ftp://a.b.c')     == 'a.b.c'
+
+
+def test_paginated():
+    import httpx
+    def handler(request):
+        page = int(request.url.params.get('page', '1'))
+        headers = {}
+        if page < 5:
+            headers['Link'] = f'<http://api.test/items?page={page + 1}>; rel="next"'
+        return httpx.Response(200, json={'page': page}, headers=headers)
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    pages = paginated('get', 'http://api.test/items', client=client, lookahead=2)
+    assert [r.json()['page'] for r in pages] == [1, 2, 3, 4, 5]
+
+
+def test_paginated_lookahead():
+    import httpx
+    from time import sleep
+    requested = []
+    def handler(request):
+        page = int(request.url.params.get('page', '1'))
+        requested.append(page)
+        link = f'<http://api.test/items?page={page + 1}>; rel="next"'
+        return httpx.Response(200, json={'page': page}, headers={'Link': link})
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    pages = paginated('get', 'http://api.test/items', client=client, lookahead=2)
+    assert next(pages).json()['page'] == 1
+    sleep(0.5)
+    assert requested == [1, 2, 3]
+    pages.close()
+
+
+def test_paginated_cursor():
+    import httpx
+    def handler(request):
+        cursor = int(request.url.params.get('cursor', '0'))
+        body = {'items': [cursor], 'meta': {'next': cursor + 1 if cursor < 2 else None}}
+        return httpx.Response(200, json=body)
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    pages = paginated('get', 'http://api.test/items?size=1', client=client,
+                      next_page=cursor_link('meta.next'))
+    assert [r.json()['items'][0] for r in pages] == [0, 1, 2]
+
+
+def test_paginated_error():
+    import httpx
+    def handler(request):
+        if request.url.params.get('page') == '2':
+            return httpx.Response(404)
+        return httpx.Response(200, headers={'Link': '</items?page=2>; rel="next"'})
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    pages = paginated('get', 'http://api.test/items', client=client)
+    assert next(pages).status_code == 200
+    with pytest.raises(NoContent):
+        next(pages)
+
+
+def test_adaptive_limiter():
+    import httpx
+    limiter = AdaptiveLimiter(initial=2, maximum=8)
+    ok = httpx.Response(200)
+    for _ in range(20):
+        limiter.release(limiter.acquire('http://a.test/x'), ok)
+    assert limiter.limit('http://a.test/y') > 4
+    assert limiter.adjustments()[-1].reason == 'healthy'
+    high = limiter.limit('http://a.test/')
+    limiter.release(limiter.acquire('http://a.test/x'), httpx.Response(503))
+    assert limiter.limit('http://a.test/') == high / 2
+    assert limiter.adjustments()[-1].reason == 'unavailable'
+    # Other hosts are unaffected.
+    assert limiter.limit('http://b.test/') == 2
+
+
+def test_adaptive_limiter_single_decrease():
+    import httpx
+    limiter = AdaptiveLimiter(initial=8)
+    tokens = [limiter.acquire('http://a.test/') for _ in range(4)]
+    for token in tokens:
+        limiter.release(token, httpx.Response(429))
+    assert limiter.limit('http://a.test/') == 4
+    assert limiter.in_flight('http://a.test/') == 0
+
+
+def test_adaptive_limiter_net():
+    import httpx
+    client = httpx.Client(transport=httpx.MockTransport(lambda r: httpx.Response(429)))
+    limiter = AdaptiveLimiter(initial=4)
+    (response, error) = limiter.net('get', 'http://a.test/', client=client)
+    assert isinstance(error, RateLimitExceeded)
+    assert limiter.limit('http://a.test/') == 2
+
+
+def test_upload(tmpdir):
+    import httpx
+    data = os.urandom(100000)
+    source = tmpdir.join('data.bin')
+    with open(source, 'wb') as f:
+        f.write(data)
+    received = {}
+    def handler(request):
+        received['headers'] = request.headers
+        received['body'] = request.read()
+        return httpx.Response(201)
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    result = upload('http://up.test/file', str(source), client=client, chunk_size=4096)
+    assert received['body'] == data
+    assert received['headers']['content-length'] == str(len(data))
+    assert result.size == len(data)
+    assert result.parts[0].attempts == 1
+    upload('http://up.test/file', str(source), client=client, chunked=True)
+    assert received['body'] == data
+    assert received['headers']['transfer-encoding'] == 'chunked'
+
+
+def test_upload_parts(tmpdir):
+    import httpx
+    import threading
+    data = os.urandom(100000)
+    source = tmpdir.join('data.bin')
+    with open(source, 'wb') as f:
+        f.write(data)
+    parts = {}
+    lock = threading.Lock()
+    def handler(request):
+        number = int(request.url.params['part'])
+        with lock:
+            parts[number] = request.read()
+        return httpx.Response(200)
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    result = upload('http://up.test/file', str(source), client=client,
+                    part_size=30000, part_url=lambda n: f'http://up.test/file?part={n}')
+    assert len(result.parts) == 4
+    assert b''.join(parts[n] for n in sorted(parts)) == data
+
+
+def test_download_queue(tmpdir):
+    dbfile = str(tmpdir.join('queue.db'))
+    with DownloadQueue(dbfile) as queue:
+        queue.add_many((f'http://dl.test/{n}', str(tmpdir.join(f'{n}.txt'))) for n in range(50))
+        assert queue.counts()['pending'] == 50
+        # Simulate a crash after some downloads were claimed but not finished.
+        claimed = queue.claim(5)
+        assert [t.url for t in claimed] == [f'http://dl.test/{n}' for n in range(5)]
+        queue.done(claimed[0], 0)
+
+    def fake_download(url, dest):
+        if url.endswith('/7'):
+            raise ServiceFailure('failed')
+        with open(dest, 'w') as f:
+            f.write(url)
+
+    with DownloadQueue(dbfile) as queue:
+        assert queue.counts() == {'pending': 49, 'in-progress': 0, 'done': 1, 'failed': 0}
+        counts = queue.run(workers=4, max_attempts=2, downloader=fake_download)
+        assert counts == {'pending': 0, 'in-progress': 0, 'done': 49, 'failed': 1}
+        failures = list(queue.entries('failed'))
+        assert failures[0][0] == 'http://dl.test/7'
+        assert failures[0][3] == 2
+
+
+def test_net_max_bytes():
+    import httpx
+    import gzip
+    def handler(request):
+        if request.url.path == '/stream':
+            return httpx.Response(200, content=iter([b'x' * 1000] * 10))
+        if request.url.path == '/gzip':
+            return httpx.Response(200, content=gzip.compress(b'{"a": 1}'),
+                                  headers={'Content-Encoding': 'gzip'})
+        return httpx.Response(200, content=b'x' * 10000)
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    (response, error) = net('get', 'http://big.test/file', client=client, max_bytes=5000)
+    assert isinstance(error, ResponseTooLarge)
+    (response, error) = net('get', 'http://big.test/stream', client=client, max_bytes=5000)
+    assert isinstance(error, ResponseTooLarge)
+    (response, error) = net('get', 'http://big.test/stream', client=client, max_bytes=50000)
+    assert error is None
+    assert response.text == 'x' * 10000
+    (response, error) = net('get', 'http://big.test/gzip', client=client, max_bytes=100)
+    assert error is None
+    assert response.json() == {'a': 1}
+    assert response.headers['content-length'] == '8'
+
+
+def test_net_min_rate(monkeypatch):
+    import httpx
+    import commonpy.network_utils
+    from time import sleep
+    monkeypatch.setattr(commonpy.network_utils, '_MIN_RATE_WINDOW', 0.05)
+    def slow_body():
+        for _ in range(5):
+            sleep(0.05)
+            yield b'x'
+    client = httpx.Client(transport=httpx.MockTransport(
+        lambda request: httpx.Response(200, content=slow_body())))
+    (response, error) = net('get', 'http://slow.test/', client=client, min_rate=1000)
+    assert isinstance(error, TransferStalled)
+
+
+def test_download_max_bytes(tmpdir):
+    import threading
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b'x' * 100000)
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/file'
+    dest = str(tmpdir.join('file'))
+    try:
+        with pytest.raises(ResponseTooLarge):
+            download(url, dest, max_bytes=1000)
+        assert not os.path.exists(dest)
+        download(url, dest, max_bytes=1000000)
+        assert os.path.getsize(dest) == 100000
+    finally:
+        server.shutdown()